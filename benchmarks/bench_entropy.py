@@ -0,0 +1,85 @@
+"""Compare the vectorized run-length codec against the original Python loop.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_entropy --sizes 0.25 1 4
+"""
+import argparse
+import time
+
+import numpy as np
+import pywt
+
+from wavelet_webapp.compression import (calculate_std_threshold, entropy_decode, entropy_encode, quantize,
+                                        std_thresholding)
+
+
+def legacy_entropy_encode(data):
+    encoded = []
+    previous_value = data[0]
+    count = 1
+    for value in data[1:]:
+        if value == previous_value:
+            count += 1
+        else:
+            encoded.append((previous_value, count))
+            previous_value = value
+            count = 1
+    encoded.append((previous_value, count))
+    return encoded
+
+
+def legacy_entropy_decode(encoded):
+    decoded = []
+    for value, count in encoded:
+        decoded.extend([value] * count)
+    return np.array(decoded)
+
+
+def synthetic_subband(megapixels, seed=0):
+    side = int(np.sqrt(megapixels * 1e6))
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:side, 0:side]
+    image = 127 + 60 * np.sin(x / 37.0) * np.cos(y / 23.0) + rng.normal(0, 8, (side, side))
+    coeffs = pywt.wavedec2(np.clip(image, 0, 255), 'haar', level=1)
+    coeffs = std_thresholding(coeffs, calculate_std_threshold(coeffs))
+    cH = quantize(coeffs[1], 10)[0]
+    return np.repeat(np.repeat(cH, 2, axis=0), 2, axis=1).flatten()
+
+
+def best_of(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=float, nargs='+', default=[0.25, 1, 4])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'MP':>6} {'runs':>10} {'legacy s/MP':>12} {'numpy s/MP':>12} {'speedup':>8}")
+    for megapixels in args.sizes:
+        data = synthetic_subband(megapixels)
+        mp = data.size / 1e6
+
+        legacy_time, legacy_encoded = best_of(lambda: legacy_entropy_encode(data), 1)
+        legacy_decode_time, legacy_decoded = best_of(lambda: legacy_entropy_decode(legacy_encoded), 1)
+        numpy_time, (values, run_lengths) = best_of(lambda: entropy_encode(data), args.repeat)
+        numpy_decode_time, decoded = best_of(lambda: entropy_decode((values, run_lengths)), args.repeat)
+
+        assert [(v, int(c)) for v, c in zip(values, run_lengths)] == legacy_encoded
+        assert np.array_equal(decoded, legacy_decoded)
+
+        legacy_total = legacy_time + legacy_decode_time
+        numpy_total = numpy_time + numpy_decode_time
+        print(f'{mp:6.2f} {len(values):10d} {legacy_total / mp:12.4f} {numpy_total / mp:12.4f} '
+              f'{legacy_total / numpy_total:7.0f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Import time and resident memory of the web app modules, each in a fresh interpreter.
+
+Reports wall time for django.setup() plus the module import, the peak RSS of
+the process and which heavy optional libraries the import pulled in:
+
+    python -m benchmarks.bench_imports --repeat 5
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+MODULES = ('wavelet_webapp.views', 'wavelet_webapp.jobs', 'wavelet_webapp.operations',
+           'wavelet_webapp.compression', 'wavelet_webapp.encryption', 'wavelet_webapp.enhancement')
+HEAVY_MODULES = ('matplotlib', 'skimage', 'scipy')
+
+
+def run_child(module):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dissertation_project.settings')
+    start = time.perf_counter()
+    import django
+    django.setup()
+    __import__(module)
+    elapsed = time.perf_counter() - start
+    print(json.dumps({
+        'seconds': elapsed,
+        'peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'heavy': [name for name in HEAVY_MODULES if name in sys.modules],
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modules', nargs='+', default=MODULES)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child)
+        return
+
+    print(f"{'module':>28} {'median s':>9} {'peak MB':>8}  heavy imports")
+    for module in args.modules:
+        results = []
+        for _ in range(args.repeat):
+            output = subprocess.run([sys.executable, '-m', 'benchmarks.bench_imports', '--child', module],
+                                    check=True, capture_output=True, text=True).stdout
+            results.append(json.loads(output))
+        print(f"{module:>28} {statistics.median(r['seconds'] for r in results):9.3f} "
+              f"{max(r['peak_mb'] for r in results):8.1f}  {', '.join(results[0]['heavy']) or '-'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""Key-stream and permutation generation time against image size.
+
+Compares the sequential logistic_map with the multi-lane chaotic_keystream,
+and a cold chaotic_permutation call with a cached one:
+
+    python -m benchmarks.bench_keystream --sizes 0.25 1 4 8
+"""
+import argparse
+import time
+
+import numpy as np
+
+from wavelet_webapp.encryption import chaotic_keystream, chaotic_permutation, clear_permutation_cache, logistic_map
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=float, nargs='+', default=[0.25, 1, 4, 8])
+    parser.add_argument('--x0', type=float, default=0.5)
+    parser.add_argument('-r', type=float, default=3.9)
+    parser.add_argument('--skip-sequential', action='store_true',
+                        help='do not time the sequential logistic_map (slow above a few megapixels)')
+    args = parser.parse_args()
+
+    print(f"{'MP':>6} {'sequential s':>13} {'lanes s':>9} {'speedup':>8} {'perm cold s':>12} {'perm cached s':>14}")
+    for megapixels in args.sizes:
+        side = int(np.sqrt(megapixels * 1e6))
+        shape = (side, side)
+        size = side * side
+
+        sequential_time = float('nan')
+        if not args.skip_sequential:
+            sequential_time, _ = timed(lambda: logistic_map(args.x0, args.r, size))
+        lanes_time, _ = timed(lambda: chaotic_keystream(args.x0, args.r, size))
+
+        clear_permutation_cache()
+        cold_time, permutation = timed(lambda: chaotic_permutation(shape, args.x0, args.r))
+        cached_time, cached = timed(lambda: chaotic_permutation(shape, args.x0, args.r))
+        assert cached is permutation
+        assert np.array_equal(np.sort(permutation), np.arange(size))
+
+        print(f'{size / 1e6:6.2f} {sequential_time:13.3f} {lanes_time:9.3f} {sequential_time / lanes_time:7.0f}x '
+              f'{cold_time:12.3f} {cached_time:14.6f}')
+
+
+if __name__ == '__main__':
+    main()
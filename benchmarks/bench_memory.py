@@ -0,0 +1,72 @@
+"""Peak RSS of the threshold/quantize stage, legacy allocation path versus the fused path.
+
+Each mode runs in a fresh interpreter so ru_maxrss reflects only that mode:
+
+    python -m benchmarks.bench_memory --megapixels 4 16
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+
+import numpy as np
+import pywt
+
+from benchmarks.harness import synthetic_image
+from wavelet_webapp.compression import (calculate_std_threshold, compress_channel, entropy_encode, quantize,
+                                        std_thresholding)
+
+MODES = ('legacy', 'fused', 'fused-float32')
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def legacy_compress_channel(channel, wavelet, level, quantization_factor):
+    coeffs = pywt.wavedec2(channel, wavelet, level=level)
+    thresholded_coeffs = std_thresholding(coeffs, calculate_std_threshold(coeffs))
+    quantized_coeffs = [quantize(coeff, quantization_factor) for coeff in thresholded_coeffs]
+    subbands = []
+    for coeff in quantized_coeffs:
+        for subband in (coeff if isinstance(coeff, tuple) else (coeff,)):
+            subbands.append((*entropy_encode(subband), subband.shape))
+    return channel.shape, subbands
+
+
+def run_child(mode, megapixels, level):
+    image = synthetic_image(megapixels)
+    baseline = peak_rss_mb()
+    if mode == 'legacy':
+        legacy_compress_channel(image, 'haar', level, 10)
+    else:
+        compress_channel(image, 'haar', level, 10, dtype=np.float32 if mode == 'fused-float32' else np.float64)
+    print(json.dumps({'baseline_mb': baseline, 'peak_mb': peak_rss_mb()}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--megapixels', type=float, nargs='+', default=[4, 16])
+    parser.add_argument('--level', type=int, default=3)
+    parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.megapixels[0], args.level)
+        return
+
+    print(f"{'MP':>6} {'mode':>14} {'peak MB':>9} {'above image MB':>15}")
+    for megapixels in args.megapixels:
+        for mode in MODES:
+            output = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.bench_memory', '--child', mode,
+                 '--megapixels', str(megapixels), '--level', str(args.level)],
+                check=True, capture_output=True, text=True).stdout
+            result = json.loads(output)
+            print(f"{megapixels:6.2f} {mode:>14} {result['peak_mb']:9.1f} "
+                  f"{result['peak_mb'] - result['baseline_mb']:15.1f}")
+
+
+if __name__ == '__main__':
+    main()
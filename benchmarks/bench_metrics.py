@@ -0,0 +1,82 @@
+"""Metric cost of the denoising sweep: skimage versus QualityMetrics, exact and screened.
+
+Also checks the agreed tolerances: the exact engine must match skimage to
+1e-9 dB PSNR / 1e-12 SSIM, and screening must keep the exact winner on its
+shortlist. Exits non-zero if either check fails.
+
+    python -m benchmarks.bench_metrics --sizes 256 512 1024
+"""
+import argparse
+import sys
+import time
+from itertools import product
+
+import numpy as np
+
+from wavelet_webapp.enhancement import (DEFAULT_DENOISING_GRID, QualityMetrics, _shortlist, add_gaussian_noise,
+                                        compute_psnr, compute_ssim, denoise_coeffs, wavelet_decompositions)
+
+
+def sweep_candidates(noisy):
+    grid = DEFAULT_DENOISING_GRID
+    candidates = []
+    for wavelet in grid['wavelets']:
+        decompositions = wavelet_decompositions(noisy, wavelet, grid['levels'])
+        for level, threshold_factor, threshold_mode in product(grid['levels'], grid['threshold_factors'],
+                                                                grid['threshold_modes']):
+            candidates.append(denoise_coeffs(decompositions[level], wavelet, threshold_factor, threshold_mode))
+    return candidates
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512, 1024])
+    parser.add_argument('--factor', type=int, default=2)
+    parser.add_argument('--top-k', type=int, default=4)
+    args = parser.parse_args()
+
+    failures = 0
+    print(f"{'side':>6} {'skimage s':>10} {'engine s':>9} {'screened s':>11} {'max dPSNR':>10} {'max dSSIM':>10} "
+          f"{'winner kept':>12}")
+    for side in args.sizes:
+        np.random.seed(side)
+        y, x = np.mgrid[0:side, 0:side]
+        original = 0.5 + 0.4 * np.sin(x / 9.0) * np.cos(y / 7.0)
+        candidates = sweep_candidates(add_gaussian_noise(original))
+
+        skimage_time, reference = timed(
+            lambda: np.array([(compute_psnr(original, c), compute_ssim(original, c)) for c in candidates]))
+        def engine():
+            quality = QualityMetrics(original)
+            return np.array([quality.evaluate(c) for c in candidates])
+
+        engine_time, exact = timed(engine)
+
+        def screened():
+            quality = QualityMetrics(original)
+            screening_quality = QualityMetrics(original, factor=args.factor)
+            approximate = [(c, *screening_quality.evaluate(c)) for c in candidates]
+            shortlist = _shortlist(approximate, args.top_k)
+            return shortlist, [quality.evaluate(candidates[i]) for i in shortlist]
+
+        screened_time, (shortlist, _) = timed(screened)
+
+        psnr_error = np.max(np.abs(exact[:, 0] - reference[:, 0]))
+        ssim_error = np.max(np.abs(exact[:, 1] - reference[:, 1]))
+        winner_kept = all(int(np.argmax(reference[:, k])) in shortlist for k in (0, 1))
+        failures += psnr_error > 1e-9 or ssim_error > 1e-12 or not winner_kept
+
+        print(f'{side:6d} {skimage_time:10.3f} {engine_time:9.3f} {screened_time:11.3f} {psnr_error:10.1e} '
+              f'{ssim_error:10.1e} {str(winner_kept):>12}')
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
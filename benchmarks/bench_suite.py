@@ -0,0 +1,225 @@
+"""Throughput, latency percentiles and peak memory of the wavelet pipelines.
+
+Runs every case over synthetic images of each size and wavelet. Results can
+be saved as a JSON baseline and later runs compared against it; the command
+exits non-zero when a case is slower or allocates more than the tolerance:
+
+    python -m benchmarks.bench_suite --sizes 0.25 1 4 16 50 --save baseline.json
+    python -m benchmarks.bench_suite --sizes 0.25 1 4 16 50 --baseline baseline.json
+
+Peak memory is the tracemalloc peak of one extra untimed run, which covers
+NumPy buffers. The thumbnail cases cut each image into 64x64 tiles and time
+one call per tile against the batched same-shape variants. Cases that are too slow for large images have a size cap and
+are skipped above it.
+"""
+import argparse
+import io
+import os
+import sys
+import tempfile
+from functools import lru_cache
+
+import numpy as np
+
+from benchmarks.harness import load_baseline, measure, regressions, save_baseline, synthetic_image
+from wavelet_webapp.compression import (compress_batch, compress_image, compress_to_target, decompress_batch,
+                                        decompress_image)
+from wavelet_webapp.encryption import (chaotic_wavelet_decrypt, chaotic_wavelet_encrypt, chaotic_wavelet_encrypt_batch,
+                                       logistic_map)
+from wavelet_webapp.enhancement import (add_gaussian_noise, nl_means_denoising, wavelet_denoising,
+                                        wavelet_denoising_batch)
+
+THUMBNAIL_SIDE = 64
+
+
+def compress_case(image, wavelet):
+    return lambda: compress_image(image, wavelet=wavelet, level=3)
+
+
+def compress_target_case(image, wavelet):
+    return lambda: compress_to_target(image, target_ratio=20, wavelet=wavelet, level=3)
+
+
+def decompress_case(image, wavelet):
+    bitstream, _, _ = compress_image(image, wavelet=wavelet, level=3)
+    return lambda: decompress_image(bitstream)
+
+
+def preview_case(image, wavelet):
+    bitstream, _, _ = compress_image(image, wavelet=wavelet, level=3)
+    return lambda: decompress_image(bitstream, scale=8)
+
+
+def encrypt_case(image, wavelet):
+    image = image.astype(np.float32) / 255
+    return lambda: chaotic_wavelet_encrypt(image, wavelet=wavelet, mode='periodization')
+
+
+def decrypt_case(image, wavelet):
+    encrypted_image = chaotic_wavelet_encrypt(image.astype(np.float32) / 255, wavelet=wavelet, mode='periodization')
+    return lambda: chaotic_wavelet_decrypt(encrypted_image, wavelet=wavelet, mode='periodization', shape=image.shape)
+
+
+def logistic_map_case(image, wavelet):
+    return lambda: logistic_map(0.5, 3.9, image.size)
+
+
+def wavelet_denoising_case(image, wavelet):
+    noisy = add_gaussian_noise(image / 255.0)
+    return lambda: wavelet_denoising(noisy, wavelet=wavelet, level=2)
+
+
+def nl_means_case(image, wavelet):
+    noisy = add_gaussian_noise(image / 255.0)
+    return lambda: nl_means_denoising(noisy)
+
+
+def thumbnails(image):
+    side = THUMBNAIL_SIDE
+    height, width = (image.shape[0] // side) * side, (image.shape[1] // side) * side
+    tiles = image[:height, :width].reshape(height // side, side, width // side, side, *image.shape[2:])
+    return np.ascontiguousarray(np.swapaxes(tiles, 1, 2).reshape(-1, side, side, *image.shape[2:]))
+
+
+def thumbnails_compress_case(image, wavelet):
+    stack = thumbnails(image)
+    return lambda: [compress_image(thumbnail, wavelet=wavelet, level=3) for thumbnail in stack]
+
+
+def thumbnails_compress_batch_case(image, wavelet):
+    stack = thumbnails(image)
+    return lambda: compress_batch(stack, wavelet=wavelet, level=3)
+
+
+def thumbnails_decompress_case(image, wavelet):
+    bitstreams = [bitstream for bitstream, _, _ in compress_batch(thumbnails(image), wavelet=wavelet, level=3)]
+    return lambda: [decompress_image(bitstream) for bitstream in bitstreams]
+
+
+def thumbnails_decompress_batch_case(image, wavelet):
+    bitstreams = [bitstream for bitstream, _, _ in compress_batch(thumbnails(image), wavelet=wavelet, level=3)]
+    return lambda: decompress_batch(bitstreams)
+
+
+def thumbnails_encrypt_case(image, wavelet):
+    stack = thumbnails(image).astype(np.float32) / 255
+    return lambda: [chaotic_wavelet_encrypt(thumbnail, wavelet=wavelet, mode='periodization') for thumbnail in stack]
+
+
+def thumbnails_encrypt_batch_case(image, wavelet):
+    stack = thumbnails(image).astype(np.float32) / 255
+    return lambda: chaotic_wavelet_encrypt_batch(stack, wavelet=wavelet, mode='periodization')
+
+
+def thumbnails_denoising_case(image, wavelet):
+    noisy = add_gaussian_noise(thumbnails(image) / 255.0)
+    return lambda: [wavelet_denoising(thumbnail, wavelet=wavelet, level=2) for thumbnail in noisy]
+
+
+def thumbnails_denoising_batch_case(image, wavelet):
+    noisy = add_gaussian_noise(thumbnails(image) / 255.0)
+    return lambda: wavelet_denoising_batch(noisy, wavelet=wavelet, level=2)
+
+
+@lru_cache(maxsize=None)
+def _client():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dissertation_project.settings')
+    import django
+    from django.conf import settings
+    django.setup()
+    settings.MEDIA_ROOT = tempfile.mkdtemp(prefix='bench-media-')
+    settings.ALLOWED_HOSTS = ['testserver']
+    settings.WAVELET_JOB_WORKERS = 0
+    settings.WAVELET_CACHE_ENABLED = False
+
+    from django.test.runner import DiscoverRunner
+    from django.test.utils import setup_test_environment
+    setup_test_environment()
+    DiscoverRunner(verbosity=0).setup_databases()
+    from django.test import Client
+    return Client()
+
+
+def view_case(operation, form=None):
+    def case(image, wavelet):
+        from PIL import Image
+        client = _client()
+        png = io.BytesIO()
+        Image.fromarray(image).save(png, 'PNG', compress_level=1)
+
+        def request():
+            upload = io.BytesIO(png.getvalue())
+            upload.name = 'bench.png'
+            response = client.post('/upload/', {'image': upload, 'operation': operation})
+            response = client.post(response['Location'], form(wavelet) if form else {}, follow=True)
+            if response.status_code != 200:
+                raise RuntimeError(f'{operation} view returned {response.status_code}')
+        return request
+    return case
+
+
+CASES = {
+    'compress': (compress_case, None, True),
+    'compress_target': (compress_target_case, None, True),
+    'decompress': (decompress_case, None, True),
+    'preview': (preview_case, None, True),
+    'encrypt': (encrypt_case, None, True),
+    'decrypt': (decrypt_case, None, True),
+    'logistic_map': (logistic_map_case, 4, False),
+    'wavelet_denoising': (wavelet_denoising_case, None, True),
+    'nl_means': (nl_means_case, 1, False),
+    'thumbnails_compress': (thumbnails_compress_case, 4, True),
+    'thumbnails_compress_batch': (thumbnails_compress_batch_case, 4, True),
+    'thumbnails_decompress': (thumbnails_decompress_case, 4, True),
+    'thumbnails_decompress_batch': (thumbnails_decompress_batch_case, 4, True),
+    'thumbnails_encrypt': (thumbnails_encrypt_case, 4, True),
+    'thumbnails_encrypt_batch': (thumbnails_encrypt_batch_case, 4, True),
+    'thumbnails_denoising': (thumbnails_denoising_case, 4, True),
+    'thumbnails_denoising_batch': (thumbnails_denoising_batch_case, 4, True),
+    'view_compress': (view_case('compress', lambda wavelet: {'level': 3}), 16, False),
+    'view_encrypt': (view_case('encrypt'), 16, False),
+    'view_enhance': (view_case('enhance', lambda wavelet: {
+        'wavelets': wavelet, 'levels': '1', 'threshold_factors': '0.1', 'threshold_modes': 'soft'}), 4, True),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=float, nargs='+', default=[0.25, 1, 4])
+    parser.add_argument('--wavelets', nargs='+', default=['haar', 'db4'])
+    parser.add_argument('--cases', nargs='+', choices=CASES, default=list(CASES))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--save', metavar='PATH', help='write the results as a JSON baseline')
+    parser.add_argument('--baseline', metavar='PATH', help='compare against a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative slowdown or memory growth before a case counts as a regression')
+    args = parser.parse_args()
+
+    results = {}
+    print(f"{'case':>27} {'wavelet':>8} {'MP':>6} {'MP/s':>8} {'p50 s':>8} {'p90 s':>8} {'p99 s':>8} {'peak MB':>8}")
+    for megapixels in args.sizes:
+        image = synthetic_image(megapixels)
+        for name in args.cases:
+            make_case, max_megapixels, per_wavelet = CASES[name]
+            if max_megapixels is not None and megapixels > max_megapixels:
+                continue
+            for wavelet in args.wavelets if per_wavelet else args.wavelets[:1]:
+                result = measure(make_case(image, wavelet), repeat=args.repeat)
+                result['mp_per_s'] = megapixels / result['p50']
+                label = wavelet if per_wavelet else '-'
+                results[f'{name}/{label}/{megapixels:g}'] = result
+                print(f"{name:>27} {label:>8} {megapixels:6.2f} {result['mp_per_s']:8.2f} {result['p50']:8.3f} "
+                      f"{result['p90']:8.3f} {result['p99']:8.3f} {result['peak_mb']:8.1f}")
+
+    if args.save:
+        save_baseline(args.save, results)
+    if args.baseline:
+        found = regressions(load_baseline(args.baseline), results, args.tolerance)
+        for key, metric, before, after in found:
+            print(f'REGRESSION {key} {metric}: {before:.3f} -> {after:.3f}')
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
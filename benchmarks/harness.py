@@ -0,0 +1,69 @@
+import json
+import platform
+import time
+import tracemalloc
+
+import numpy as np
+
+
+def synthetic_image(megapixels, seed=0):
+    side = int(np.sqrt(megapixels * 1e6))
+    rng = np.random.default_rng(seed)
+    image = np.empty((side, side), dtype=np.uint8)
+    for top in range(0, side, 256):
+        y, x = np.mgrid[top:min(top + 256, side), 0:side]
+        strip = 127 + 60 * np.sin(x / 37.0) * np.cos(y / 23.0) + rng.normal(0, 8, x.shape)
+        image[top:top + 256] = np.clip(strip, 0, 255)
+    return image
+
+
+def measure(func, repeat=5, warmup=1):
+    for _ in range(warmup):
+        func()
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return {'p50': p50, 'p90': p90, 'p99': p99, 'min': min(latencies), 'peak_mb': peak / 2 ** 20}
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def save_baseline(path, results):
+    with open(path, 'w') as f:
+        json.dump({'environment': environment(), 'results': results}, f, indent=2, sort_keys=True)
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def regressions(baseline, results, tolerance):
+    found = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        for metric in ('p50', 'peak_mb'):
+            before, after = baseline[key][metric], result[metric]
+            if before > 0 and after > before * (1 + tolerance):
+                found.append((key, metric, before, after))
+    return found
@@ -41,6 +41,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'wavelet_webapp.middleware.StageTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -128,4 +129,57 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 STATICFILES_DIRS = [
     os.path.join(BASE_DIR, 'static'),
-]
\ No newline at end of file
+]
+
+FILE_UPLOAD_HANDLERS = ['django.core.files.uploadhandler.TemporaryFileUploadHandler']
+
+# Wavelet processing
+WAVELET_JOB_WORKERS = 2
+# a pending or running job whose row has not changed for this many seconds is presumed lost and marked failed
+WAVELET_JOB_TIMEOUT = 30 * 60
+WAVELET_TILED_MIN_PIXELS = 16_000_000
+WAVELET_TILE_SIZE = 1024
+WAVELET_TILE_OVERLAP = 16
+WAVELET_TILE_WORKERS = None
+WAVELET_DENOISING_GRID = {
+    'wavelets': ['bior4.4', 'db4', 'sym4'],
+    'levels': [1, 2],
+    'threshold_factors': [0.1, 0.2],
+    'threshold_modes': ['soft', 'hard'],
+}
+WAVELET_DENOISING_POOL = 'thread'
+WAVELET_DENOISING_WORKERS = None
+# e.g. {'factor': 2, 'top_k': 4} ranks candidates at half resolution and scores only the top four exactly
+WAVELET_DENOISING_SCREENING = None
+WAVELET_CACHE_ENABLED = True
+WAVELET_CACHE_MAX_BYTES = 1 << 30
+# seconds an artifact directory or an unused decoded pixel array is kept before `manage.py sweep_artifacts` removes it
+WAVELET_ARTIFACT_RETENTION = 24 * 60 * 60
+WAVELET_BATCH_WORKERS = None
+WAVELET_BATCH_CHUNK_SIZE = 8
+# directory that batch API requests may read images from; None allows uploaded image ids only
+WAVELET_BATCH_ROOT = None
+# longest side of the enhancement preview thumbnails; None serves full-resolution images only
+WAVELET_THUMBNAIL_SIZE = 256
+# serve the processing views as async views (for ASGI deployments); WAVELET_ASYNC_VIEWS=1 in the environment
+WAVELET_ASYNC_VIEWS = os.environ.get('WAVELET_ASYNC_VIEWS') == '1'
+WAVELET_ASYNC_WORKERS = 4
+# requests beyond this many concurrently offloaded calls per process get a 429
+WAVELET_MAX_IN_FLIGHT = 16
+# processing requests get a 429 while this many jobs are pending or running (stale rows excluded)
+WAVELET_MAX_PENDING_JOBS = 32
+WAVELET_RETRY_AFTER = 5
+# `?profile` (or `?profile=tottime`) returns a cProfile report instead of the page
+WAVELET_PROFILING_ENABLED = DEBUG
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'wavelet_webapp.timing': {'handlers': ['console'], 'level': 'INFO'},
+        'wavelet_webapp.jobs': {'handlers': ['console'], 'level': 'ERROR'},
+    },
+}
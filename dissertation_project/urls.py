@@ -1,16 +1,25 @@
 from django.conf import settings
 from django.contrib import admin
 from django.urls import path
-from wavelet_webapp import views as wavelet_views
+from wavelet_webapp import async_views, views as wavelet_views
 from django.conf.urls.static import static
 
+processing_views = async_views if settings.WAVELET_ASYNC_VIEWS else wavelet_views
+
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path('upload/', wavelet_views.upload_image, name='upload_image'),
-    path('encrypt/<int:uploaded_image_id>/', wavelet_views.encrypt_image, name='encrypt_image'),
-    path('decrypt/', wavelet_views.decrypt_image, name='decrypt_image'),
-    path('compress/<int:uploaded_image_id>/', wavelet_views.compress_image_view, name='compress_image'),
-    path('enhance/<int:uploaded_image_id>/', wavelet_views.process_image, name='enhance_image'),
+    path('upload/', processing_views.upload_image, name='upload_image'),
+    path('encrypt/<int:uploaded_image_id>/', processing_views.encrypt_image, name='encrypt_image'),
+    path('decrypt/', processing_views.decrypt_image, name='decrypt_image'),
+    path('compress/<int:uploaded_image_id>/', processing_views.compress_image_view, name='compress_image'),
+    path('enhance/<int:uploaded_image_id>/', processing_views.process_image, name='enhance_image'),
+    path('jobs/<int:job_id>/', wavelet_views.job_detail, name='job_detail'),
+    path('jobs/<int:job_id>/status/', wavelet_views.job_status, name='job_status'),
+    path('download/<path:name>', wavelet_views.download_artifact, name='download_artifact'),
+    path('files/<path:name>', wavelet_views.artifact_file, name='artifact_file'),
+    path('preview/<path:name>', wavelet_views.compressed_preview, name='compressed_preview'),
+    path('metrics/', wavelet_views.metrics, name='metrics'),
+    path('batch/', wavelet_views.batch_process, name='batch_process'),
     path('', wavelet_views.home_view, name='home'),
 ]
 
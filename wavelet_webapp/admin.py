@@ -1,3 +1,10 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import Job
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'operation', 'status', 'progress', 'created_at', 'updated_at')
+    list_filter = ('operation', 'status')
+    readonly_fields = ('error',)
@@ -0,0 +1,51 @@
+import struct
+import zipfile
+
+import numpy as np
+
+_LOCAL_HEADER = struct.Struct('<4s22xHH')
+BATCH_BYTES = 1 << 20
+
+
+def _member_memmap(path, f, info):
+    f.seek(info.header_offset)
+    _, name_length, extra_length = _LOCAL_HEADER.unpack(f.read(_LOCAL_HEADER.size))
+    f.seek(info.header_offset + _LOCAL_HEADER.size + name_length + extra_length)
+
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    if dtype.hasobject:
+        raise ValueError('Object arrays cannot be memory-mapped')
+    if not shape or 0 in shape:
+        return np.fromfile(f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+    return np.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                     order='F' if fortran_order else 'C')
+
+
+def load_arrays(file):
+    if hasattr(file, 'temporary_file_path'):
+        file = file.temporary_file_path()
+    if not isinstance(file, str):
+        with np.load(file) as data:
+            return {name: data[name] for name in data.files}
+
+    arrays = {}
+    with zipfile.ZipFile(file) as archive, open(file, 'rb') as f:
+        for info in archive.infolist():
+            name = info.filename[:-len('.npy')]
+            if info.compress_type == zipfile.ZIP_STORED:
+                arrays[name] = _member_memmap(file, f, info)
+            else:
+                with archive.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+    return arrays
+
+
+def batch_slices(n_images, image_nbytes, batch_bytes=BATCH_BYTES):
+    # whole-stack NumPy passes stop paying off once their operands fall out of cache,
+    # so image stacks are worked through in chunks of about batch_bytes per operand
+    step = max(1, batch_bytes // max(1, image_nbytes))
+    return [slice(start, start + step) for start in range(0, n_images, step)]
@@ -0,0 +1,60 @@
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+
+ARTIFACTS_DIR = 'artifacts'
+
+
+def new_namespace(owner):
+    return f'{ARTIFACTS_DIR}/{owner}/{uuid.uuid4().hex}'
+
+
+def media_path(relative_path):
+    return os.path.join(settings.MEDIA_ROOT, relative_path)
+
+
+def media_url(relative_path):
+    return os.path.join(settings.MEDIA_URL, relative_path)
+
+
+@contextmanager
+def atomic_path(relative_path):
+    path = media_path(relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    root, extension = os.path.splitext(path)
+    temporary_path = f'{root}.{uuid.uuid4().hex}.tmp{extension}'
+    try:
+        yield temporary_path
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+
+def sweep_artifacts(max_age):
+    root = media_path(ARTIFACTS_DIR)
+    if not os.path.isdir(root):
+        return 0
+    cutoff = time.time() - max_age
+    removed = 0
+    for owner in os.scandir(root):
+        if not owner.is_dir():
+            continue
+        for namespace in os.scandir(owner.path):
+            try:
+                last_modified = max([namespace.stat().st_mtime] +
+                                    [entry.stat().st_mtime for entry in os.scandir(namespace.path)])
+            except (NotADirectoryError, FileNotFoundError):
+                continue
+            if last_modified < cutoff:
+                shutil.rmtree(namespace.path, ignore_errors=True)
+                removed += 1
+        try:
+            os.rmdir(owner.path)
+        except OSError:
+            pass
+    return removed
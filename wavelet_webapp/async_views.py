@@ -0,0 +1,136 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import HttpResponse
+from django.shortcuts import aget_object_or_404, redirect, render
+
+from .forms import CompressionForm, DenoisingGridForm, UploadImageForm
+from .jobs import live_jobs, submit_job
+from .models import UploadedImage
+from .timing import bind
+from .views import decrypt_upload, save_upload
+
+_executor = None
+_executor_lock = threading.Lock()
+_in_flight = 0
+
+
+class Overloaded(Exception):
+    pass
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.WAVELET_ASYNC_WORKERS,
+                                           thread_name_prefix='wavelet-async')
+        return _executor
+
+
+def _with_connections(func, *args):
+    close_old_connections()
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+async def offload(func, *args):
+    global _in_flight
+    if _in_flight >= settings.WAVELET_MAX_IN_FLIGHT:
+        raise Overloaded
+    _in_flight += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(get_executor(), bind(_with_connections), func, *args)
+    finally:
+        _in_flight -= 1
+
+
+def too_many_requests():
+    response = HttpResponse('Too many images are being processed, please retry shortly.', status=429,
+                            content_type='text/plain')
+    response['Retry-After'] = str(settings.WAVELET_RETRY_AFTER)
+    return response
+
+
+async def upload_image(request):
+    if request.method == 'POST':
+        form = UploadImageForm(request.POST, request.FILES)
+        if form.is_valid():
+            try:
+                uploaded_image = await offload(save_upload, form)
+            except Overloaded:
+                return too_many_requests()
+            operation = form.cleaned_data['operation']
+            if operation == 'encrypt':
+                return redirect('encrypt_image', uploaded_image_id=uploaded_image.id)
+            elif operation == 'compress':
+                return redirect('compress_image', uploaded_image_id=uploaded_image.id)
+            elif operation == 'enhance':
+                return redirect('enhance_image', uploaded_image_id=uploaded_image.id)
+    else:
+        form = UploadImageForm()
+    return render(request, 'wavelet_webapp/upload_image.html', {'form': form})
+
+
+async def _submit(uploaded_image, operation, params=None):
+    # submit_job returns once the job is queued, so the bound is on the job queue itself;
+    # rows orphaned by a dead worker or a restart stop counting once they go stale
+    active_jobs = await live_jobs().acount()
+    if active_jobs >= settings.WAVELET_MAX_PENDING_JOBS:
+        return too_many_requests()
+    try:
+        job = await offload(submit_job, uploaded_image, operation, params)
+    except Overloaded:
+        return too_many_requests()
+    return redirect('job_detail', job_id=job.id)
+
+
+async def encrypt_image(request, uploaded_image_id):
+    uploaded_image = await aget_object_or_404(UploadedImage, pk=uploaded_image_id)
+
+    if request.method == 'POST':
+        return await _submit(uploaded_image, 'encrypt')
+
+    return render(request, 'wavelet_webapp/encrypt_image.html', {'uploaded_image': uploaded_image})
+
+
+async def decrypt_image(request):
+    if request.method == 'POST':
+        try:
+            context = await offload(decrypt_upload, request.FILES['npz_file'])
+        except Overloaded:
+            return too_many_requests()
+        return render(request, 'wavelet_webapp/decryption_success.html', context)
+
+    return render(request, 'wavelet_webapp/decrypt_image.html')
+
+
+async def compress_image_view(request, uploaded_image_id):
+    uploaded_image = await aget_object_or_404(UploadedImage, pk=uploaded_image_id)
+
+    if request.method == 'POST':
+        form = CompressionForm(request.POST)
+        if form.is_valid():
+            return await _submit(uploaded_image, 'compress', form.params())
+    else:
+        form = CompressionForm()
+
+    return render(request, 'wavelet_webapp/compress_image.html', {'uploaded_image': uploaded_image, 'form': form})
+
+
+async def process_image(request, uploaded_image_id):
+    uploaded_image = await aget_object_or_404(UploadedImage, pk=uploaded_image_id)
+
+    if request.method == 'POST':
+        form = DenoisingGridForm(request.POST)
+        if form.is_valid():
+            return await _submit(uploaded_image, 'enhance', {'grid': form.grid()})
+    else:
+        form = DenoisingGridForm()
+
+    return render(request, 'wavelet_webapp/enhance_image.html', {'uploaded_image': uploaded_image, 'form': form})
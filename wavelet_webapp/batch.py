@@ -0,0 +1,147 @@
+import glob
+import json
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from django.conf import settings
+from django.core.files import File
+
+from .models import UploadedImage
+from .operations import OPERATIONS
+from .timing import collect
+from .workers import init_worker
+
+IMAGE_EXTENSIONS = ('.bmp', '.gif', '.jpeg', '.jpg', '.png', '.tif', '.tiff', '.webp')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _make_executor(max_workers):
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=init_worker, initargs=(os.environ['DJANGO_SETTINGS_MODULE'],))
+
+
+def get_executor():
+    # batch API requests share one pool instead of each starting its own
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = _make_executor(settings.WAVELET_BATCH_WORKERS or os.cpu_count())
+        return _executor
+
+
+def collect_sources(paths=(), ids=()):
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            sources.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                  if name.lower().endswith(IMAGE_EXTENSIONS)))
+        elif glob.has_magic(path):
+            sources.extend(sorted(glob.glob(path, recursive=True)))
+        else:
+            sources.append(path)
+    sources.extend(f'upload:{uploaded_image_id}' for uploaded_image_id in ids)
+    return sources
+
+
+def completed_sources(output_path, operation):
+    completed = set()
+    try:
+        with open(output_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('operation') == operation and record.get('status') == 'ok':
+                    completed.add(record['source'])
+    except FileNotFoundError:
+        pass
+    return completed
+
+
+def _uploaded_image(source):
+    if source.startswith('upload:'):
+        return UploadedImage.objects.get(pk=int(source[len('upload:'):]))
+    with open(source, 'rb') as f:
+        uploaded_image = UploadedImage(image=File(f, name=os.path.basename(source)))
+        uploaded_image.save()
+    return uploaded_image
+
+
+def _discard(uploaded_image):
+    # a failed file source is imported again on retry, so its upload must not outlive the attempt
+    uploaded_image.image.delete(save=False)
+    uploaded_image.delete()
+
+
+def process_source(source, operation, params):
+    record = {'source': source, 'operation': operation}
+    start = time.perf_counter()
+    uploaded_image = None
+    with collect() as timings:
+        try:
+            uploaded_image = _uploaded_image(source)
+            result = OPERATIONS[operation](uploaded_image, params)
+        except Exception:
+            record.update(status='error', seconds=time.perf_counter() - start, timings=timings.summary(),
+                          error=traceback.format_exc())
+            if source.startswith('upload:'):
+                record['upload_id'] = int(source[len('upload:'):])
+            elif uploaded_image is not None:
+                _discard(uploaded_image)
+            return record
+
+    record.update(status='ok', upload_id=uploaded_image.id, seconds=time.perf_counter() - start,
+                  timings=timings.summary())
+    record.update((name, value) for name, value in result.items() if isinstance(value, (int, float)))
+    if result.get('rate_control'):
+        record['rate_control'] = result['rate_control']
+    record['artifacts'] = result.get('artifacts', [])
+    return record
+
+
+def _process_chunk(sources, operation, params):
+    return [process_source(source, operation, params) for source in sources]
+
+
+def run_batch(sources, operation, output_path, params=None, max_workers=None, chunk_size=8, executor=None):
+    params = params or {}
+    completed = completed_sources(output_path, operation)
+    pending_sources = [source for source in dict.fromkeys(sources) if source not in completed]
+    chunks = [pending_sources[i:i + chunk_size] for i in range(0, len(pending_sources), chunk_size)]
+
+    max_workers = max_workers or os.cpu_count()
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    own_executor = executor is None
+    if own_executor:
+        executor = _make_executor(max_workers)
+    try:
+        with open(output_path, 'a') as output:
+            yield from _drain(executor, chunks, operation, params, output, max_workers)
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+
+def _drain(executor, chunks, operation, params, output, max_workers):
+    chunks = iter(chunks)
+    running = set()
+    while True:
+        for chunk in chunks:
+            running.add(executor.submit(_process_chunk, chunk, operation, params))
+            if len(running) >= 2 * max_workers:
+                break
+        if not running:
+            break
+        done, running = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            for record in future.result():
+                output.write(json.dumps(record) + '\n')
+                output.flush()
+                yield record
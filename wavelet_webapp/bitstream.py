@@ -0,0 +1,267 @@
+import mmap
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b'WLTB'
+VERSION = 3
+
+COLORSPACE_GRAY = 0
+COLORSPACE_YCBCR = 1
+
+_PREAMBLE = struct.Struct('<4sBB')
+_PARAMS = struct.Struct('<Bd')
+_COLOUR = struct.Struct('<BBB')
+_CHANNEL = struct.Struct('<IIH')
+_SUBBAND = struct.Struct('<IIIII')
+
+
+class BitstreamError(ValueError):
+    pass
+
+
+def zigzag_encode(values):
+    values = np.asarray(values, dtype=np.int64)
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+def zigzag_decode(values):
+    values = np.asarray(values, dtype=np.uint64)
+    return (values >> np.uint64(1)).view(np.int64) ^ -(values & np.uint64(1)).view(np.int64)
+
+def varint_nbytes(values):
+    nbytes = np.ones(values.shape, dtype=np.int64)
+    for k in range(1, 10):
+        longer = values >= np.uint64(1 << (7 * k))
+        if not longer.any():
+            break
+        nbytes += longer
+    return nbytes
+
+def varint_encode(values):
+    values = np.asarray(values, dtype=np.uint64)
+    return _varint_pack(values, varint_nbytes(values))
+
+def varint_encode_many(streams):
+    # one vectorized pass over several streams laid end to end, split back per stream
+    values = np.concatenate([np.asarray(stream, dtype=np.uint64) for stream in streams])
+    nbytes = varint_nbytes(values)
+    ends = np.concatenate(([0], np.cumsum(nbytes)))[np.cumsum([len(stream) for stream in streams])]
+    return np.split(_varint_pack(values, nbytes), ends[:-1])
+
+def _varint_pack(values, nbytes):
+    offsets = np.cumsum(nbytes) - nbytes
+    out = np.empty(int(nbytes.sum()), dtype=np.uint8)
+    for k in range(int(nbytes.max(initial=0))):
+        mask = nbytes > k
+        chunk = (values[mask] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        chunk |= np.where(nbytes[mask] > k + 1, np.uint64(0x80), np.uint64(0))
+        out[offsets[mask] + k] = chunk
+    return out
+
+def varint_decode(buffer):
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    if data.size == 0:
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(data < 0x80)
+    if ends.size == 0 or ends[-1] != data.size - 1:
+        raise BitstreamError('Truncated varint stream')
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    positions = np.arange(data.size) - np.repeat(starts, ends - starts + 1)
+    chunks = (data & 0x7F).astype(np.uint64) << (7 * positions).astype(np.uint64)
+    return np.bitwise_or.reduceat(chunks, starts)
+
+
+def encode_bitstream(shape, wavelet, level, quantization_factor, channels,
+                     colorspace=COLORSPACE_GRAY, chroma_subsampling=1):
+    return encode_bitstreams(shape, wavelet, level, quantization_factor, [channels], colorspace,
+                             chroma_subsampling)[0]
+
+def encode_bitstreams(shape, wavelet, level, quantization_factor, batch_channels,
+                      colorspace=COLORSPACE_GRAY, chroma_subsampling=1):
+    # same-shaped images share the header; each subband is varint coded for all of them at once
+    wavelet_name = wavelet.encode('ascii')
+    header = [
+        _PREAMBLE.pack(MAGIC, VERSION, len(shape)),
+        struct.pack(f'<{len(shape)}I', *shape),
+        bytes([len(wavelet_name)]), wavelet_name,
+        _PARAMS.pack(level, quantization_factor),
+        _COLOUR.pack(colorspace, chroma_subsampling, len(batch_channels[0])),
+    ]
+
+    encoded = {}
+    for c, (_, subbands) in enumerate(batch_channels[0]):
+        for index in range(len(subbands)):
+            entries = [channels[c][1][index] for channels in batch_channels]
+            encoded[c, index] = (varint_encode_many([zigzag_encode(values) for values, _, _ in entries]),
+                                 varint_encode_many([run_lengths for _, run_lengths, _ in entries]))
+    order = progressive_order(colorspace, chroma_subsampling, [len(subbands) for _, subbands in batch_channels[0]])
+
+    bitstreams = []
+    for i, channels in enumerate(batch_channels):
+        table = []
+        for c, (channel_shape, subbands) in enumerate(channels):
+            table.append(_CHANNEL.pack(*channel_shape, len(subbands)))
+            for index, (values, _, subband_shape) in enumerate(subbands):
+                encoded_values, encoded_run_lengths = encoded[c, index][0][i], encoded[c, index][1][i]
+                table.append(_SUBBAND.pack(*subband_shape, len(values), encoded_values.size, encoded_run_lengths.size))
+        payloads = [encoded[c, index][part][i] for c, index, _ in order for part in (0, 1)]
+        bitstreams.append(_join(header + table + payloads))
+    return bitstreams
+
+def _join(parts):
+    bitstream = bytearray(sum(memoryview(part).nbytes for part in parts))
+    offset = 0
+    for part in parts:
+        part = memoryview(part).cast('B')
+        bitstream[offset:offset + part.nbytes] = part
+        offset += part.nbytes
+    return bitstream
+
+def progressive_order(colorspace, chroma_subsampling, subband_counts):
+    # payloads go approximation bands first, then detail bands from the coarsest
+    # resolution to the finest, so any prefix of the stream decodes to a smaller image
+    order = []
+    for c, n_subbands in enumerate(subband_counts):
+        factor = chroma_subsampling if colorspace == COLORSPACE_YCBCR and c else 1
+        levels = (n_subbands - 1) // 3
+        for index in range(n_subbands):
+            order.append((index > 0, -factor * 2 ** (levels - (index + 2) // 3), c, index))
+    order.sort()
+    return [(c, index, -negative_scale) for _, negative_scale, c, index in order]
+
+def read_layout(buffer):
+    view = memoryview(buffer).cast('B')
+    if view.nbytes < _PREAMBLE.size:
+        raise BitstreamError('Bitstream is too short')
+    magic, version, ndim = _PREAMBLE.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise BitstreamError('Not a wavelet bitstream')
+    if version != VERSION:
+        raise BitstreamError(f'Unsupported bitstream version {version}')
+    offset = _PREAMBLE.size
+
+    try:
+        shape = struct.unpack_from(f'<{ndim}I', view, offset)
+        offset += 4 * ndim
+        name_length = view[offset]
+        wavelet = bytes(view[offset + 1:offset + 1 + name_length]).decode('ascii')
+        offset += 1 + name_length
+        level, quantization_factor = _PARAMS.unpack_from(view, offset)
+        offset += _PARAMS.size
+        colorspace, chroma_subsampling, n_channels = _COLOUR.unpack_from(view, offset)
+        offset += _COLOUR.size
+
+        tables = []
+        for _ in range(n_channels):
+            height, width, n_subbands = _CHANNEL.unpack_from(view, offset)
+            offset += _CHANNEL.size
+            table = []
+            for _ in range(n_subbands):
+                table.append(_SUBBAND.unpack_from(view, offset))
+                offset += _SUBBAND.size
+            tables.append(((height, width), table))
+    except (IndexError, struct.error):
+        raise BitstreamError('Truncated bitstream header')
+
+    layout = []
+    for c, index, scale in progressive_order(colorspace, chroma_subsampling, [len(table) for _, table in tables]):
+        values_nbytes, run_lengths_nbytes = tables[c][1][index][3:]
+        layout.append((c, index, scale, offset))
+        offset += values_nbytes + run_lengths_nbytes
+
+    header = {
+        'shape': shape,
+        'wavelet': wavelet,
+        'level': level,
+        'quantization_factor': quantization_factor,
+        'colorspace': colorspace,
+        'chroma_subsampling': chroma_subsampling,
+    }
+    return header, tables, layout
+
+def _needed(layout, scale):
+    return [entry for entry in layout if entry[1] == 0 or 2 * entry[2] > scale]
+
+def _payload_end(tables, entries):
+    c, index, _, offset = entries[-1]
+    return offset + sum(tables[c][1][index][3:])
+
+def scale_for_budget(buffer, max_bytes):
+    _, tables, layout = read_layout(buffer)
+    coarsest = max(scale for _, index, scale, _ in layout if index == 0)
+    scale = 1
+    while scale < coarsest and _payload_end(tables, _needed(layout, scale)) > max_bytes:
+        scale *= 2
+    return scale
+
+def decode_bitstream(buffer, scale=1):
+    view = memoryview(buffer).cast('B')
+    header, tables, layout = read_layout(view)
+    needed = _needed(layout, scale)
+    if _payload_end(tables, needed) > view.nbytes:
+        raise BitstreamError('Truncated bitstream')
+
+    subbands = [{} for _ in tables]
+    for c, index, _, offset in needed:
+        height, width, n_runs, values_nbytes, run_lengths_nbytes = tables[c][1][index]
+        values = zigzag_decode(varint_decode(view[offset:offset + values_nbytes]))
+        offset += values_nbytes
+        run_lengths = varint_decode(view[offset:offset + run_lengths_nbytes]).astype(np.int64)
+        if values.size != n_runs or run_lengths.size != n_runs or run_lengths.sum() != height * width:
+            raise BitstreamError('Corrupt subband payload')
+        subbands[c][index] = (values, run_lengths, (height, width))
+
+    channels = [(channel_shape, [decoded[index] for index in sorted(decoded)], (len(table) - 1) // 3)
+                for (channel_shape, table), decoded in zip(tables, subbands)]
+    return header, channels
+
+def decode_bitstreams(buffers):
+    # streams sharing one layout are decoded together: a subband's payloads from every
+    # stream go through a single varint pass and come back laid end to end
+    views = [memoryview(buffer).cast('B') for buffer in buffers]
+    layouts = [read_layout(view) for view in views]
+    header, tables, layout = layouts[0]
+    shapes = [(channel_shape, [entry[:2] for entry in table]) for channel_shape, table in tables]
+    for view, (other_header, other_tables, other_layout) in zip(views, layouts):
+        if other_header != header or [(channel_shape, [entry[:2] for entry in table])
+                                      for channel_shape, table in other_tables] != shapes:
+            raise BitstreamError('Bitstreams do not share one layout')
+        if _payload_end(other_tables, other_layout) > view.nbytes:
+            raise BitstreamError('Truncated bitstream')
+
+    subbands = [{} for _ in tables]
+    for position, (c, index, _, _) in enumerate(layout):
+        height, width = tables[c][1][index][:2]
+        value_parts, run_length_parts, n_runs = [], [], []
+        for view, (_, other_tables, other_layout) in zip(views, layouts):
+            _, _, runs, values_nbytes, run_lengths_nbytes = other_tables[c][1][index]
+            offset = other_layout[position][3]
+            value_parts.append(view[offset:offset + values_nbytes])
+            run_length_parts.append(view[offset + values_nbytes:offset + values_nbytes + run_lengths_nbytes])
+            n_runs.append(runs)
+        values = zigzag_decode(varint_decode(b''.join(value_parts)))
+        run_lengths = varint_decode(b''.join(run_length_parts)).astype(np.int64)
+        n_runs = np.array(n_runs)
+        if (values.size != n_runs.sum() or run_lengths.size != n_runs.sum() or not n_runs.all()
+                or np.any(np.add.reduceat(run_lengths, np.cumsum(n_runs) - n_runs) != height * width)):
+            raise BitstreamError('Corrupt subband payload')
+        subbands[c][index] = (values, run_lengths, (height, width))
+
+    channels = [(channel_shape, [decoded[index] for index in sorted(decoded)], (len(table) - 1) // 3)
+                for (channel_shape, table), decoded in zip(tables, subbands)]
+    return header, channels
+
+def write_bitstream(path, bitstream):
+    size = len(bitstream)
+    with open(path, 'wb+') as f:
+        f.truncate(size)
+        if size:
+            with mmap.mmap(f.fileno(), size) as mapped:
+                mapped[:] = bitstream
+
+def open_bitstream(path):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise BitstreamError('Bitstream is too short')
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+
+from django.conf import settings
+
+from .artifacts import atomic_path
+
+_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def cache_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def merge_stats(counts):
+    # stores and evictions happen in job worker processes; their counts are merged into the web process's
+    with _stats_lock:
+        for name, count in counts.items():
+            _stats[name] += count
+
+
+def cache_root():
+    return os.path.join(settings.MEDIA_ROOT, 'cache')
+
+
+def file_digest(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_key(content_digest, operation, params, context=None):
+    digest = hashlib.sha256(content_digest.encode())
+    digest.update(b'\0' + operation.encode() + b'\0')
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    digest.update(b'\0' + json.dumps(context or {}, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def _entry_dir(key):
+    return os.path.join(cache_root(), key[:2], key)
+
+
+def _link_or_copy(source, destination):
+    # artifacts are replaced, never modified in place, so entries and namespaces can share inodes
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def _rename_artifacts(value, renames):
+    if isinstance(value, str):
+        for old_name, new_name in renames.items():
+            value = value.replace(old_name, new_name)
+    elif isinstance(value, list):
+        value = [_rename_artifacts(item, renames) for item in value]
+    elif isinstance(value, dict):
+        value = {name: _rename_artifacts(item, renames) for name, item in value.items()}
+    return value
+
+
+def lookup(key, namespace):
+    if not settings.WAVELET_CACHE_ENABLED:
+        return None
+    result_path = os.path.join(_entry_dir(key), 'result.json')
+    try:
+        with open(result_path) as f:
+            result = json.load(f)
+        renames = {}
+        for index, relative_path in enumerate(result.get('artifacts', [])):
+            renames[relative_path] = f'{namespace}/{os.path.basename(relative_path)}'
+            with atomic_path(renames[relative_path]) as destination:
+                _link_or_copy(os.path.join(_entry_dir(key), f'artifact_{index}'), destination)
+        os.utime(result_path)
+    except (OSError, ValueError):
+        _count('misses')
+        return None
+    _count('hits')
+    return _rename_artifacts(result, renames)
+
+
+def store(key, result):
+    if not settings.WAVELET_CACHE_ENABLED:
+        return
+    entry_dir = _entry_dir(key)
+    staging_dir = f'{entry_dir}.{uuid.uuid4().hex}.tmp'
+    os.makedirs(staging_dir)
+    try:
+        for index, relative_path in enumerate(result.get('artifacts', [])):
+            _link_or_copy(os.path.join(settings.MEDIA_ROOT, relative_path),
+                          os.path.join(staging_dir, f'artifact_{index}'))
+        with open(os.path.join(staging_dir, 'result.json'), 'w') as f:
+            json.dump(result, f)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(staging_dir, entry_dir)
+    except OSError:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        return
+    _count('stores')
+    evict(settings.WAVELET_CACHE_MAX_BYTES)
+
+
+def _entry_size(entry_dir):
+    return sum(entry.stat().st_size for entry in os.scandir(entry_dir) if entry.is_file())
+
+
+def evict(max_bytes):
+    entries = []
+    root = cache_root()
+    for prefix in os.scandir(root) if os.path.isdir(root) else ():
+        for entry in os.scandir(prefix.path):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                last_used = os.stat(os.path.join(entry.path, 'result.json')).st_mtime
+                entries.append((last_used, _entry_size(entry.path), entry.path))
+            except OSError:
+                continue
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, entry_path in sorted(entries):
+        if total_size <= max_bytes:
+            break
+        shutil.rmtree(entry_path, ignore_errors=True)
+        total_size -= size
+        _count('evictions')
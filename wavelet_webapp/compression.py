@@ -1,7 +1,22 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import pywt
 from PIL import Image
 
+from .arrays import batch_slices
+from .bitstream import (COLORSPACE_GRAY, COLORSPACE_YCBCR, decode_bitstream, decode_bitstreams, encode_bitstream,
+                        encode_bitstreams, read_layout, scale_for_budget, varint_nbytes, zigzag_encode)
+from .timing import bind, stage
+
+_RGB_TO_YCBCR = np.array([[0.299, 0.587, 0.114],
+                          [-0.168736, -0.331264, 0.5],
+                          [0.5, -0.418688, -0.081312]])
+_YCBCR_TO_RGB = np.linalg.inv(_RGB_TO_YCBCR)
+
+DETAIL_KEYS = ('da', 'ad', 'dd')
+PSNR_CEILING_MARGIN = 0.1
+
 def calculate_std_threshold(coeffs):
     thresholds = {}
     for i, (cH, cV, cD) in enumerate(coeffs[1:]):
@@ -32,80 +47,418 @@ def dequantize(quantized_coefficients, quantization_factor):
         return quantized_coefficients * quantization_factor
 
 def entropy_encode(data):
-    encoded = []
-    previous_value = data[0]
-    count = 1
-    for value in data[1:]:
-        if value == previous_value:
-            count += 1
-        else:
-            encoded.append((previous_value, count))
-            previous_value = value
-            count = 1
-    encoded.append((previous_value, count))
-    return encoded
+    data = np.ravel(data)
+    if data.size == 0:
+        return data[:0], np.zeros(0, dtype=np.min_scalar_type(0))
+    run_starts = np.flatnonzero(data[1:] != data[:-1]) + 1
+    run_starts = np.concatenate(([0], run_starts))
+    run_lengths = np.diff(np.append(run_starts, data.size))
+    return data[run_starts], run_lengths.astype(np.min_scalar_type(data.size))
+
+def entropy_encode_batch(data):
+    data = data.reshape(len(data), -1)
+    run_starts = np.ones(data.shape, dtype=bool)
+    np.not_equal(data[:, 1:], data[:, :-1], out=run_starts[:, 1:])
+    splits = np.cumsum(run_starts.sum(axis=1))[:-1]
+    run_starts = np.flatnonzero(run_starts)
+    run_lengths = np.diff(np.append(run_starts, data.size)).astype(np.min_scalar_type(data.shape[1]))
+    return list(zip(np.split(data.ravel()[run_starts], splits), np.split(run_lengths, splits)))
 
 def entropy_decode(encoded):
-    decoded = []
-    for value, count in encoded:
-        decoded.extend([value] * count)
-    return np.array(decoded)
+    values, run_lengths = encoded
+    return np.repeat(values, run_lengths)
 
 def calculate_compression_ratio(original_size, compressed_size):
     return original_size / compressed_size
 
-def calculate_psnr(original_image, decompressed_image):
-    mse = np.mean((original_image.astype(float) - decompressed_image.astype(float)) ** 2)
+def calculate_psnr(original_image, decompressed_image, axis=None):
+    mse = np.mean((original_image.astype(float) - decompressed_image.astype(float)) ** 2, axis=axis)
+    max_pixel = 255.0
+    if axis is not None:
+        with np.errstate(divide='ignore'):
+            return 20 * np.log10(max_pixel / np.sqrt(mse))
     if mse == 0:
         return float('inf')
-    max_pixel = 255.0
     psnr = 20 * np.log10(max_pixel / np.sqrt(mse))
     return psnr
 
-def compress_image(image_array, wavelet='haar', quantization_factor=10):
-    coeffs = pywt.wavedec2(image_array, wavelet, level=1)
+def rgb_to_ycbcr(rgb_image, dtype=np.float64):
+    rgb_image = rgb_image[..., :3].astype(dtype)
+    ycbcr_image = rgb_image @ _RGB_TO_YCBCR.T.astype(dtype)
+    ycbcr_image[..., 1:] += 128
+    return ycbcr_image
 
-    thresholds = calculate_std_threshold(coeffs)
+def ycbcr_to_rgb(ycbcr_image):
+    ycbcr_image = ycbcr_image.astype(np.float64)
+    ycbcr_image[..., 1:] -= 128
+    return ycbcr_image @ _YCBCR_TO_RGB.T
 
-    thresholded_coeffs = std_thresholding(coeffs, thresholds)
+def subsample_chroma(channel, factor):
+    if factor == 1:
+        return channel
+    height, width = channel.shape[-2:]
+    pad_height, pad_width = -height % factor, -width % factor
+    channel = np.pad(channel, [(0, 0)] * (channel.ndim - 2) + [(0, pad_height), (0, pad_width)], mode='edge')
+    blocks = channel.reshape(channel.shape[:-2] + (channel.shape[-2] // factor, factor,
+                                                   channel.shape[-1] // factor, factor))
+    return blocks.mean(axis=(-3, -1))
 
-    quantized_coeffs = [quantize(coeff, quantization_factor) for coeff in thresholded_coeffs]
+def upsample_chroma(channel, factor, shape):
+    if factor == 1:
+        return channel
+    channel = np.repeat(np.repeat(channel, factor, axis=-2), factor, axis=-1)
+    return channel[..., :shape[0], :shape[1]]
 
-    encoded_coeffs = {}
-    for i, coeff in enumerate(quantized_coeffs):
-        if isinstance(coeff, tuple):
-            for j, subband in enumerate(coeff):
-                encoded_coeffs[f'coeff_{i}_{j}'] = entropy_encode(subband.flatten())
-        else:
-            encoded_coeffs[f'coeff_{i}_0'] = entropy_encode(coeff.flatten())
-
-    original_size = image_array.size
-    compressed_size = sum(len(encoded) for encoded in encoded_coeffs.values())
-
-    return encoded_coeffs, coeffs, original_size, compressed_size
-
-def decompress_image(encoded_coeffs, wavelet_coeffs, shape_image, wavelet='haar', quantization_factor=10):
-    decoded_coeffs = []
-    for i, coeff in enumerate(wavelet_coeffs):
-        if isinstance(coeff, tuple):
-            subbands = []
-            for j in range(len(coeff)):
-                encoded_key = f'coeff_{i}_{j}'
-                decoded_subband = entropy_decode(encoded_coeffs[encoded_key])
-                subbands.append(decoded_subband.reshape(coeff[j].shape))
-            decoded_coeffs.append(tuple(dequantize(subband, quantization_factor) for subband in subbands))
+def resample_plane(plane, shape):
+    if plane.shape == tuple(shape):
+        return plane
+    rows = np.arange(shape[0]) * plane.shape[0] // shape[0]
+    cols = np.arange(shape[1]) * plane.shape[1] // shape[1]
+    return plane[rows[:, None], cols]
+
+def preview_scale(shape, max_side):
+    scale = 1
+    while max_side and -(-max(shape[:2]) // scale) > max_side:
+        scale *= 2
+    return scale
+
+def threshold_subbands(coeff_arr, coeff_slices, measure=False):
+    # the removed energy is only needed by rate control, so plain compression skips that pass
+    removed = 0.0 if measure else None
+    for level_slices in coeff_slices[1:]:
+        for key in DETAIL_KEYS:
+            subband = coeff_arr[level_slices[key]]
+            mask = np.abs(subband) <= np.std(subband, axis=(-2, -1), keepdims=True)
+            if measure:
+                removed += float(np.sum(np.square(subband[mask])))
+            subband[mask] = 0
+    return removed
+
+def quantize_array(coeff_arr, quantization_factor, out=None):
+    scaled = np.divide(coeff_arr, quantization_factor, out=out)
+    limit = max(scaled.max(), -scaled.min())
+    quantized = np.empty(scaled.shape, dtype=np.int16 if limit < np.iinfo(np.int16).max else np.int32)
+    np.rint(scaled, out=quantized, casting='unsafe')
+    return quantized
+
+def threshold_quantize(coeff_arr, coeff_slices, quantization_factor):
+    threshold_subbands(coeff_arr, coeff_slices)
+    return quantize_array(coeff_arr, quantization_factor, out=coeff_arr)
+
+def iter_subbands(coeff_arr, coeff_slices):
+    for level_slices in coeff_slices:
+        for key in (DETAIL_KEYS if isinstance(level_slices, dict) else (None,)):
+            yield coeff_arr[level_slices[key] if key else level_slices]
+
+def decompose_channel(channel, wavelet, level, dtype=np.float64):
+    level = max(1, min(level, pywt.dwt_max_level(min(channel.shape[-2:]), wavelet)))
+    with stage('compress.wavedec2'):
+        coeffs = pywt.wavedec2(np.asarray(channel, dtype=dtype), wavelet, level=level, axes=(-2, -1))
+        coeff_arr, coeff_slices = pywt.coeffs_to_array(coeffs, axes=(-2, -1))
+    return coeff_arr, coeff_slices
+
+def encode_subbands(quantized, coeff_slices):
+    subbands = []
+    with stage('compress.rle'):
+        for subband in iter_subbands(quantized, coeff_slices):
+            values, run_lengths = entropy_encode(subband)
+            subbands.append((values, run_lengths, subband.shape))
+    return subbands
+
+def compress_channel(channel, wavelet, level, quantization_factor, dtype=np.float64):
+    coeff_arr, coeff_slices = decompose_channel(channel, wavelet, level, dtype=dtype)
+
+    with stage('compress.threshold'):
+        quantized = threshold_quantize(coeff_arr, coeff_slices, quantization_factor)
+        del coeff_arr
+
+    return channel.shape, encode_subbands(quantized, coeff_slices)
+
+def approximation_offset(wavelet, levels):
+    # each analysis step delays the approximation by the low-pass filter's centroid
+    lowpass = np.asarray(pywt.Wavelet(wavelet).dec_lo)
+    centroid = np.dot(np.arange(lowpass.size), lowpass) / lowpass.sum()
+    return int(round((2 ** levels - 1) * (centroid - 0.5) / 2 ** levels))
+
+def decompress_channel(channel_shape, subbands, levels, wavelet, quantization_factor, dtype=np.float64):
+    decoded_subbands = []
+    with stage('decompress.rle'):
+        for values, run_lengths, shape in subbands:
+            decoded_subband = entropy_decode((values, run_lengths)).reshape(shape).astype(dtype)
+            decoded_subband *= quantization_factor
+            decoded_subbands.append(decoded_subband)
+    decoded_coeffs = [decoded_subbands[0]]
+    for i in range(1, len(decoded_subbands), 3):
+        decoded_coeffs.append(tuple(decoded_subbands[i:i + 3]))
+
+    with stage('decompress.waverec2'):
+        reconstructed_channel = pywt.waverec2(decoded_coeffs, wavelet)
+    skipped = levels - (len(decoded_coeffs) - 1)
+    if skipped == 0:
+        return reconstructed_channel[:channel_shape[0], :channel_shape[1]]
+
+    # an approximation band at level j carries a gain of 2 ** j for orthogonal wavelets
+    reconstructed_channel /= 2 ** skipped
+    height, width = (-(-size // 2 ** skipped) for size in channel_shape)
+    offset = approximation_offset(wavelet, skipped)
+    top = min(offset, reconstructed_channel.shape[0] - height)
+    left = min(offset, reconstructed_channel.shape[1] - width)
+    return reconstructed_channel[top:top + height, left:left + width]
+
+def color_planes(image_array, chroma_subsampling=2, dtype=np.float64, batched=False):
+    if image_array.ndim == (4 if batched else 3):
+        with stage('compress.color'):
+            ycbcr_image = rgb_to_ycbcr(image_array, dtype=dtype)
+            planes = [ycbcr_image[..., 0]] + [subsample_chroma(ycbcr_image[..., c], chroma_subsampling)
+                                              for c in (1, 2)]
+        return COLORSPACE_YCBCR, chroma_subsampling, planes, ycbcr_image
+    return COLORSPACE_GRAY, 1, [image_array], None
+
+def _encode(image_array, wavelet, level, quantization_factor, channels, colorspace, chroma_subsampling):
+    with stage('compress.encode'):
+        return encode_bitstream(image_array.shape[:2] + (len(channels),) if colorspace == COLORSPACE_YCBCR
+                                else image_array.shape, wavelet, level, quantization_factor, channels,
+                                colorspace=colorspace, chroma_subsampling=chroma_subsampling)
+
+def compress_image(image_array, wavelet='haar', quantization_factor=10, level=1, chroma_subsampling=2,
+                   max_workers=None, dtype=np.float64):
+    colorspace, chroma_subsampling, planes, _ = color_planes(image_array, chroma_subsampling, dtype=dtype)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        channels = list(executor.map(
+            bind(lambda plane: compress_channel(plane, wavelet, level, quantization_factor, dtype=dtype)), planes))
+
+    bitstream = _encode(image_array, wavelet, level, quantization_factor, channels, colorspace, chroma_subsampling)
+
+    original_size = image_array.nbytes
+    compressed_size = len(bitstream)
+
+    return bitstream, original_size, compressed_size
+
+def compress_batch(images, wavelet='haar', quantization_factor=10, level=1, chroma_subsampling=2,
+                   dtype=np.float64):
+    # images share one shape and are stacked on a leading axis; each gets its own bitstream,
+    # identical to what compress_image() produces for it alone
+    images = np.asarray(images)
+    results = []
+    for chunk in batch_slices(len(images), images[0].size * np.dtype(dtype).itemsize):
+        results.extend(_compress_chunk(images[chunk], wavelet, quantization_factor, level, chroma_subsampling, dtype))
+    return results
+
+def _compress_chunk(images, wavelet, quantization_factor, level, chroma_subsampling, dtype):
+    colorspace, chroma_subsampling, planes, _ = color_planes(images, chroma_subsampling, dtype=dtype, batched=True)
+
+    channels = [[] for _ in images]
+    for plane in planes:
+        coeff_arr, coeff_slices = decompose_channel(plane, wavelet, level, dtype=dtype)
+        with stage('compress.threshold'):
+            quantized = threshold_quantize(coeff_arr, coeff_slices, quantization_factor)
+            del coeff_arr
+        subbands = list(iter_subbands(quantized, coeff_slices))
+        with stage('compress.rle'):
+            encoded = [entropy_encode_batch(subband) for subband in subbands]
+        for i, image_channels in enumerate(channels):
+            image_channels.append((plane.shape[1:], [(*runs[i], subband.shape[1:])
+                                                     for runs, subband in zip(encoded, subbands)]))
+
+    shape = images.shape[1:3] + (len(planes),) if colorspace == COLORSPACE_YCBCR else images.shape[1:]
+    with stage('compress.encode'):
+        bitstreams = encode_bitstreams(shape, wavelet, level, quantization_factor, channels,
+                                       colorspace=colorspace, chroma_subsampling=chroma_subsampling)
+    return [(bitstream, image.nbytes, len(bitstream)) for image, bitstream in zip(images, bitstreams)]
+
+
+class RateModel:
+    # Estimates the encoded size and the pixel-domain MSE of a quantization factor
+    # from strided row samples of the thresholded coefficients, so a search only
+    # quantizes and run-length counts the samples instead of re-encoding.
+
+    def __init__(self, channels, sample_size=1 << 18):
+        self.channels = []
+        self.overhead = 64
+        for coeff_arr, coeff_slices, plane_size, base_error, weight in channels:
+            step = max(1, -(-coeff_arr.size // sample_size))
+            samples = []
+            for subband in iter_subbands(coeff_arr, coeff_slices):
+                sample = np.ascontiguousarray(subband[::step]).ravel()
+                samples.append((sample, subband.size / max(sample.size, 1)))
+                self.overhead += 20
+            self.channels.append((samples, plane_size, base_error, weight))
+            self.overhead += 10
+
+    def estimate(self, quantization_factor):
+        nbytes = self.overhead
+        mse = 1 / 12
+        for samples, plane_size, base_error, weight in self.channels:
+            squared_error = 0.0
+            for sample, scale in samples:
+                quantized = np.rint(sample / quantization_factor)
+                squared_error += scale * float(np.sum(np.square(sample - quantized * quantization_factor)))
+                values, run_lengths = entropy_encode(quantized.astype(np.int64))
+                nbytes += scale * (varint_nbytes(zigzag_encode(values)).sum()
+                                   + varint_nbytes(run_lengths.astype(np.uint64)).sum())
+            mse += weight * (squared_error + base_error) / plane_size
+        return int(nbytes), 10 * np.log10(255.0 ** 2 / mse)
+
+
+def choose_quantization(model, target_bytes=None, target_psnr=None, low=0.05, high=None, tolerance=0.01):
+    if high is None:
+        high = 2 * max(float(np.abs(sample).max(initial=0)) for samples, _, _, _ in model.channels
+                       for sample, _ in samples) + 1
+    estimates = {}
+
+    def estimate(quantization_factor):
+        if quantization_factor not in estimates:
+            estimates[quantization_factor] = model.estimate(quantization_factor)
+        return estimates[quantization_factor]
+
+    # both tests flip from False to True as the factor grows, so bisect the flip on a log scale
+    if target_bytes is not None:
+        coarse_enough = lambda quantization_factor: estimate(quantization_factor)[0] <= target_bytes
+    else:
+        # thresholding caps the PSNR; above that ceiling take the coarsest factor that stays near it
+        ceiling = estimate(low)[1]
+        if target_psnr > ceiling:
+            target_psnr = ceiling - PSNR_CEILING_MARGIN
+        coarse_enough = lambda quantization_factor: estimate(quantization_factor)[1] < target_psnr
+
+    if coarse_enough(low):
+        high = low
+    elif not coarse_enough(high):
+        low = high
+    while high / low > 1 + tolerance:
+        middle = np.sqrt(low * high)
+        if coarse_enough(middle):
+            high = middle
         else:
-            encoded_key = f'coeff_{i}_0'
-            decoded_subband = entropy_decode(encoded_coeffs[encoded_key])
-            decoded_coeffs.append(dequantize(decoded_subband.reshape(coeff.shape), quantization_factor))
+            low = middle
+
+    quantization_factor = float(high if target_bytes is not None else low)
+    return quantization_factor, estimate(quantization_factor), len(estimates)
+
+
+def compress_to_target(image_array, target_bytes=None, target_ratio=None, target_psnr=None, wavelet='haar',
+                       level=1, chroma_subsampling=2, max_workers=None, dtype=np.float64):
+    if target_ratio is not None:
+        target_bytes = image_array.nbytes / target_ratio
+    if (target_bytes is None) == (target_psnr is None):
+        raise ValueError('Give exactly one of target_bytes, target_ratio or target_psnr')
+
+    colorspace, chroma_subsampling, planes, ycbcr_image = color_planes(image_array, chroma_subsampling, dtype=dtype)
+    if colorspace == COLORSPACE_YCBCR:
+        # per-channel weights of the YCbCr errors in the mean RGB squared error
+        weights = np.sum(np.square(_YCBCR_TO_RGB), axis=0) / 3
+        subsampling_errors = [0.0] + [
+            float(np.mean(np.square(upsample_chroma(plane, chroma_subsampling, image_array.shape)
+                                    - ycbcr_image[..., c])))
+            for c, plane in zip((1, 2), planes[1:])]
+    else:
+        weights, subsampling_errors = [1.0], [0.0]
+
+    def prepare(plane):
+        coeff_arr, coeff_slices = decompose_channel(plane, wavelet, level, dtype=dtype)
+        with stage('compress.threshold'):
+            removed = threshold_subbands(coeff_arr, coeff_slices, measure=True)
+        return coeff_arr, coeff_slices, removed
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        prepared = list(executor.map(bind(prepare), planes))
+
+    with stage('compress.rate_control'):
+        model = RateModel([
+            (coeff_arr, coeff_slices, plane.size, removed + subsampling_error * plane.size, weight)
+            for (coeff_arr, coeff_slices, removed), plane, subsampling_error, weight
+            in zip(prepared, planes, subsampling_errors, weights)])
+        quantization_factor, (estimated_size, estimated_psnr), iterations = choose_quantization(
+            model, target_bytes=target_bytes, target_psnr=target_psnr)
+        del model
+
+    def encode(plane_and_prepared):
+        plane, (coeff_arr, coeff_slices, _) = plane_and_prepared
+        with stage('compress.threshold'):
+            quantized = quantize_array(coeff_arr, quantization_factor, out=coeff_arr)
+        return plane.shape, encode_subbands(quantized, coeff_slices)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        channels = list(executor.map(bind(encode), zip(planes, prepared)))
+    del prepared
+
+    bitstream = _encode(image_array, wavelet, level, quantization_factor, channels, colorspace, chroma_subsampling)
+    rate_control = {
+        'quantization_factor': quantization_factor,
+        'estimated_size': estimated_size,
+        'estimated_psnr': float(estimated_psnr),
+        'target_met': bool(estimated_size <= target_bytes if target_bytes is not None
+                           else estimated_psnr >= target_psnr),
+        'iterations': iterations,
+    }
+    return bitstream, image_array.nbytes, len(bitstream), rate_control
+
+def decompress_image(bitstream, max_workers=None, dtype=np.float64, scale=1, max_bytes=None):
+    if max_bytes is not None:
+        scale = max(scale, scale_for_budget(bitstream, max_bytes))
+    with stage('decompress.decode'):
+        header, channels = decode_bitstream(bitstream, scale=scale)
+    shape_image = header['shape']
+    if scale > 1:
+        shape_image = tuple(-(-size // scale) for size in shape_image[:2])
 
-    reconstructed_image = pywt.waverec2(decoded_coeffs, wavelet)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        planes = list(executor.map(
+            bind(lambda channel: decompress_channel(*channel, header['wavelet'], header['quantization_factor'],
+                                                    dtype=dtype)),
+            channels))
+    if scale > 1:
+        planes = [resample_plane(plane, shape_image) for plane in planes]
 
-    reconstructed_image = np.clip(reconstructed_image, 0, 255).astype(np.uint8)
+    if header['colorspace'] == COLORSPACE_YCBCR:
+        factor = header['chroma_subsampling'] if scale == 1 else 1
+        with stage('decompress.color'):
+            ycbcr_image = np.dstack([planes[0]] + [upsample_chroma(plane, factor, shape_image)
+                                                   for plane in planes[1:]])
+            reconstructed_image = ycbcr_to_rgb(ycbcr_image)
+    else:
+        reconstructed_image = planes[0]
 
-    if reconstructed_image.shape != shape_image:
-        reconstructed_image = reconstructed_image[:shape_image[0], :shape_image[1]]
+    reconstructed_image = np.clip(np.round(reconstructed_image), 0, 255).astype(np.uint8)
 
     decompressed_image = Image.fromarray(reconstructed_image)
 
     return decompressed_image
+
+def decompress_batch(bitstreams, dtype=np.float64):
+    header = read_layout(bitstreams[0])[0]
+    chunks = batch_slices(len(bitstreams), int(np.prod(header['shape'])) * np.dtype(dtype).itemsize)
+    return np.concatenate([_decompress_chunk(bitstreams[chunk], dtype) for chunk in chunks])
+
+def _decompress_chunk(bitstreams, dtype):
+    with stage('decompress.decode'):
+        header, channels = decode_bitstreams(bitstreams)
+    shape_image = header['shape']
+
+    planes = []
+    for channel_shape, subbands, _ in channels:
+        stacked_subbands = []
+        with stage('decompress.rle'):
+            for values, run_lengths, shape in subbands:
+                stacked_subband = entropy_decode((values, run_lengths)).reshape((len(bitstreams),) + shape).astype(dtype)
+                stacked_subband *= header['quantization_factor']
+                stacked_subbands.append(stacked_subband)
+        stacked_coeffs = [stacked_subbands[0]]
+        for i in range(1, len(stacked_subbands), 3):
+            stacked_coeffs.append(tuple(stacked_subbands[i:i + 3]))
+
+        with stage('decompress.waverec2'):
+            plane = pywt.waverec2(stacked_coeffs, header['wavelet'], axes=(-2, -1))
+        planes.append(plane[:, :channel_shape[0], :channel_shape[1]])
+
+    if header['colorspace'] == COLORSPACE_YCBCR:
+        factor = header['chroma_subsampling']
+        with stage('decompress.color'):
+            ycbcr_images = np.stack([planes[0]] + [upsample_chroma(plane, factor, shape_image)
+                                                   for plane in planes[1:]], axis=-1)
+            reconstructed_images = ycbcr_to_rgb(ycbcr_images)
+    else:
+        reconstructed_images = planes[0]
+
+    return np.clip(np.round(reconstructed_images), 0, 255).astype(np.uint8)
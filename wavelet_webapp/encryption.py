@@ -1,7 +1,18 @@
+import threading
+from collections import OrderedDict
+
 import numpy as np
 import pywt
-from skimage.transform import resize
-import matplotlib.pyplot as plt
+
+from .arrays import batch_slices
+from .timing import stage
+
+_GOLDEN_RATIO_CONJUGATE = (np.sqrt(5) - 1) / 2
+# a 12 MP permutation is 48 MB as int32, so a few recent keys fit without pinning gigabytes per worker
+PERMUTATION_CACHE_BYTES = 1 << 28
+
+_permutations = OrderedDict()
+_permutations_lock = threading.Lock()
 
 def logistic_map(x, r, size):
     seq = np.zeros(size)
@@ -10,47 +21,129 @@ def logistic_map(x, r, size):
         seq[i] = r * seq[i - 1] * (1 - seq[i - 1])
     return seq
 
-def chaotic_wavelet_encrypt(image, wavelet='haar', level=1, r=3.9):
-    coeffs = pywt.wavedec2(image, wavelet, level=level)
-    coeff_arr, coeff_slices = pywt.coeffs_to_array(coeffs)
-
-    x = 0.5
-    chaotic_sequence = logistic_map(x, r, coeff_arr.size)
-
-    permuted_indices = np.argsort(chaotic_sequence)
-    encrypted_coeff_arr = coeff_arr.flatten()
-    encrypted_coeff_arr = encrypted_coeff_arr[permuted_indices]
+def chaotic_keystream(x, r, size, lanes=None, burn_in=64):
+    if lanes is None:
+        lanes = max(256, int(np.ceil(np.sqrt(size))))
+    lanes = max(1, min(lanes, size))
+    steps = -(-size // lanes)
+
+    seq = np.empty((steps, lanes))
+    lane_seeds = np.modf(x + np.arange(lanes) * _GOLDEN_RATIO_CONJUGATE)[0]
+    lane_state = np.clip(lane_seeds, 1e-6, 1 - 1e-6)
+    for _ in range(burn_in):
+        lane_state = r * lane_state * (1 - lane_state)
+
+    seq[0] = lane_state
+    scratch = np.empty(lanes)
+    for i in range(1, steps):
+        np.subtract(1, seq[i - 1], out=scratch)
+        np.multiply(seq[i - 1], scratch, out=seq[i])
+        seq[i] *= r
+    return seq.ravel()[:size]
+
+def _cached_indices(key, build):
+    with _permutations_lock:
+        if key in _permutations:
+            _permutations.move_to_end(key)
+            return _permutations[key]
+    indices = build()
+    if indices.size < np.iinfo(np.int32).max:
+        indices = indices.astype(np.int32)
+    indices.setflags(write=False)
+    with _permutations_lock:
+        _permutations[key] = indices
+        total_bytes = sum(cached.nbytes for cached in _permutations.values())
+        while total_bytes > PERMUTATION_CACHE_BYTES and len(_permutations) > 1:
+            total_bytes -= _permutations.popitem(last=False)[1].nbytes
+    return indices
+
+def clear_permutation_cache():
+    with _permutations_lock:
+        _permutations.clear()
+
+def chaotic_permutation(shape, x, r):
+    return _cached_indices(('forward', tuple(shape), x, r),
+                           lambda: np.argsort(chaotic_keystream(x, r, int(np.prod(shape)))))
+
+def inverse_permutation(permuted_indices):
+    inverse_indices = np.empty_like(permuted_indices)
+    inverse_indices[permuted_indices] = np.arange(permuted_indices.size)
+    return inverse_indices
+
+def chaotic_inverse_permutation(shape, x, r):
+    # decrypting gathers through the inverse, which is much cheaper than scattering through the permutation
+    return _cached_indices(('inverse', tuple(shape), x, r),
+                           lambda: inverse_permutation(chaotic_permutation(shape, x, r)))
+
+def pad_to_levels(image, level):
+    # periodized transforms keep the shape exactly when every side divides by 2 ** level
+    padding = [(0, 0)] * (image.ndim - 2) + [(0, -size % 2 ** level) for size in image.shape[-2:]]
+    if any(after for _, after in padding):
+        image = np.pad(image, padding, mode='symmetric')
+    return image
+
+def chaotic_wavelet_encrypt(image, wavelet='haar', level=1, r=3.9, x0=0.5, mode='symmetric'):
+    # a stack of same-shaped images (leading axes) is transformed in one call, all with the same key
+    if mode == 'periodization':
+        image = pad_to_levels(image, level)
+
+    with stage('encrypt.wavedec2'):
+        coeffs = pywt.wavedec2(image, wavelet, mode=mode, level=level, axes=(-2, -1))
+        coeff_arr, coeff_slices = pywt.coeffs_to_array(coeffs, axes=(-2, -1))
+
+    with stage('encrypt.permute'):
+        permuted_indices = chaotic_permutation(coeff_arr.shape[-2:], x0, r)
+        encrypted_coeff_arr = np.take(coeff_arr.reshape(-1, permuted_indices.size), permuted_indices, axis=1)
 
     encrypted_coeff_arr = encrypted_coeff_arr.reshape(coeff_arr.shape)
 
     encrypted_coeffs = pywt.array_to_coeffs(encrypted_coeff_arr, coeff_slices, output_format='wavedec2')
 
-    encrypted_image = pywt.waverec2(encrypted_coeffs, wavelet)
+    with stage('encrypt.waverec2'):
+        encrypted_image = pywt.waverec2(encrypted_coeffs, wavelet, mode=mode, axes=(-2, -1))
+
+    return encrypted_image
 
-    return encrypted_image, permuted_indices
+def chaotic_wavelet_decrypt(encrypted_image, permuted_indices=None, wavelet='haar', level=1, r=3.9, x0=0.5,
+                            mode='symmetric', shape=None):
+    with stage('decrypt.wavedec2'):
+        encrypted_coeffs = pywt.wavedec2(encrypted_image, wavelet, mode=mode, level=level, axes=(-2, -1))
+        encrypted_coeff_arr, coeff_slices = pywt.coeffs_to_array(encrypted_coeffs, axes=(-2, -1))
 
-def chaotic_wavelet_decrypt(encrypted_image, permuted_indices, wavelet='haar', level=1, r=3.9):
-    encrypted_coeffs = pywt.wavedec2(encrypted_image, wavelet, level=level)
-    encrypted_coeff_arr, coeff_slices = pywt.coeffs_to_array(encrypted_coeffs)
+    with stage('decrypt.permute'):
+        if permuted_indices is None:
+            inverse_indices = chaotic_inverse_permutation(encrypted_coeff_arr.shape[-2:], x0, r)
+        else:
+            inverse_indices = inverse_permutation(permuted_indices)
 
-    decrypted_coeff_arr = np.zeros_like(encrypted_coeff_arr.flatten())
-    decrypted_coeff_arr[permuted_indices] = encrypted_coeff_arr.flatten()
+        decrypted_coeff_arr = np.take(encrypted_coeff_arr.reshape(-1, inverse_indices.size), inverse_indices, axis=1)
 
     decrypted_coeff_arr = decrypted_coeff_arr.reshape(encrypted_coeff_arr.shape)
 
     decrypted_coeffs = pywt.array_to_coeffs(decrypted_coeff_arr, coeff_slices, output_format='wavedec2')
 
-    decrypted_image = pywt.waverec2(decrypted_coeffs, wavelet)
+    with stage('decrypt.waverec2'):
+        decrypted_image = pywt.waverec2(decrypted_coeffs, wavelet, mode=mode, axes=(-2, -1))
 
+    if shape is not None:
+        decrypted_image = decrypted_image[(Ellipsis,) + tuple(slice(0, size) for size in shape[-2:])]
     return decrypted_image
 
+def chaotic_wavelet_encrypt_batch(images, **key):
+    images = np.asarray(images)
+    chunks = batch_slices(len(images), images[0].size * images.dtype.itemsize)
+    return np.concatenate([chaotic_wavelet_encrypt(images[chunk], **key) for chunk in chunks])
+
+def chaotic_wavelet_decrypt_batch(encrypted_images, **key):
+    chunks = batch_slices(len(encrypted_images), encrypted_images[0].size * encrypted_images.dtype.itemsize)
+    return np.concatenate([chaotic_wavelet_decrypt(encrypted_images[chunk], **key) for chunk in chunks])
+
 def resize_image(image, target_shape):
+    from skimage.transform import resize
     return resize(image, target_shape, mode='reflect', anti_aliasing=True)
 
-def psnr(original, decrypted):
-    mse = np.mean((original - decrypted) ** 2)
-    if mse == 0:
-        return float('inf')
-    max_pixel = 255.0
-    psnr_value = 20 * np.log10(max_pixel / np.sqrt(mse))
-    return psnr_value
+def psnr(original, decrypted, data_range=255.0):
+    mse = np.mean((original - decrypted) ** 2, axis=(-2, -1))
+    with np.errstate(divide='ignore'):
+        psnr_value = 20 * np.log10(data_range / np.sqrt(mse))
+    return psnr_value if np.ndim(psnr_value) else float(psnr_value)
@@ -1,7 +1,12 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
+from itertools import product
+
 import numpy as np
 import pywt
-from skimage import metrics
-from skimage.restoration import denoise_nl_means
+
+from .arrays import batch_slices
+from .timing import bind, stage
 
 def add_gaussian_noise(image, mean=0, var=0.01):
     sigma = np.sqrt(var)
@@ -9,21 +14,230 @@ def add_gaussian_noise(image, mean=0, var=0.01):
     noisy_image = image + noise
     return noisy_image
 
-def wavelet_denoising(image, wavelet='db1', level=2, threshold_factor=0.2, threshold_mode='soft'):
-    coeffs = pywt.wavedec2(image, wavelet, level=level)
-    approximation_coeffs = coeffs[0]
-    sigma = np.median(np.abs(approximation_coeffs - np.median(approximation_coeffs))) / 0.6745
+def estimate_sigma(approximation_coeffs):
+    # one estimate per image for stacks, broadcastable against their coefficients
+    keepdims = approximation_coeffs.ndim > 2
+    median = np.median(approximation_coeffs, axis=(-2, -1), keepdims=True)
+    return np.median(np.abs(approximation_coeffs - median), axis=(-2, -1), keepdims=keepdims) / 0.6745
+
+def wavelet_decompositions(image, wavelet, levels):
+    with stage('enhance.decompose'):
+        return _wavelet_decompositions(image, wavelet, levels)
+
+def _wavelet_decompositions(image, wavelet, levels):
+    max_level = max(levels)
+    coeffs = pywt.wavedec2(image, wavelet, level=max_level, axes=(-2, -1))
+    decompositions = {max_level: coeffs}
+    approximation = coeffs[0]
+    for level in range(max_level - 1, min(levels) - 1, -1):
+        finer_details = coeffs[max_level - level + 1]
+        approximation = pywt.idwt2((approximation, coeffs[max_level - level]), wavelet, axes=(-2, -1))
+        approximation = approximation[..., :finer_details[0].shape[-2], :finer_details[0].shape[-1]]
+        decompositions[level] = [approximation] + coeffs[max_level - level + 1:]
+    return {level: decompositions[level] for level in levels}
+
+def denoise_coeffs(coeffs, wavelet, threshold_factor=0.2, threshold_mode='soft', sigma=None):
+    if sigma is None:
+        sigma = estimate_sigma(coeffs[0])
     threshold = threshold_factor * sigma
     coeffs_thresh = list(coeffs)
     coeffs_thresh[1:] = [tuple(pywt.threshold(c, threshold, mode=threshold_mode) for c in subcoeffs) for subcoeffs in coeffs_thresh[1:]]
-    denoised_image = pywt.waverec2(coeffs_thresh, wavelet)
-    return denoised_image
+    return pywt.waverec2(coeffs_thresh, wavelet, axes=(-2, -1))
+
+def wavelet_denoising(image, wavelet='db1', level=2, threshold_factor=0.2, threshold_mode='soft'):
+    coeffs = pywt.wavedec2(image, wavelet, level=level, axes=(-2, -1))
+    return denoise_coeffs(coeffs, wavelet, threshold_factor, threshold_mode)
+
+def wavelet_denoising_batch(images, **params):
+    chunks = batch_slices(len(images), images[0].size * np.dtype(np.float64).itemsize)
+    return np.concatenate([wavelet_denoising(images[chunk], **params) for chunk in chunks])
 
 def nl_means_denoising(image, patch_size=5, patch_distance=6, h=0.1):
+    from skimage.restoration import denoise_nl_means
     return denoise_nl_means(image, patch_size=patch_size, patch_distance=patch_distance, h=h)
 
 def compute_psnr(original, denoised):
+    from skimage import metrics
     return metrics.peak_signal_noise_ratio(original, denoised)
 
 def compute_ssim(original, denoised):
-    return metrics.structural_similarity(original, denoised, data_range=denoised.max() - denoised.min())
\ No newline at end of file
+    from skimage import metrics
+    return metrics.structural_similarity(original, denoised, data_range=denoised.max() - denoised.min())
+
+def downsample(image, factor):
+    if factor == 1:
+        return image
+    height, width = (image.shape[-2] // factor) * factor, (image.shape[-1] // factor) * factor
+    blocks = image[..., :height, :width].reshape(image.shape[:-2] + (height // factor, factor, width // factor, factor))
+    return blocks.mean(axis=(-3, -1))
+
+
+class QualityMetrics:
+    WIN_SIZE = 7
+    K1 = 0.01
+    K2 = 0.03
+
+    def __init__(self, reference, factor=1):
+        from scipy.ndimage import uniform_filter
+
+        self.factor = factor
+        reference = downsample(reference.astype(np.float64), factor)
+        # a stack of references is scored image by image along its last two axes
+        self.window = (1,) * (reference.ndim - 2) + (self.WIN_SIZE, self.WIN_SIZE)
+        # skimage's float data range: [0, 1], or [-1, 1] when the reference has negative values
+        self.psnr_data_range = np.where(reference.min(axis=(-2, -1)) >= 0, 1.0, 2.0)
+
+        self.reference = reference
+        self.reference_power = np.mean(reference * reference, axis=(-2, -1))
+        self.ux = uniform_filter(reference, size=self.window)
+        self.uxx = uniform_filter(reference * reference, size=self.window)
+        self.cov_norm = self.WIN_SIZE ** 2 / (self.WIN_SIZE ** 2 - 1)
+        self.ux_squared = self.ux * self.ux
+        self.vx = self.cov_norm * (self.uxx - self.ux_squared)
+
+    def evaluate(self, image):
+        if image.ndim == 2:
+            return self._evaluate(image, Ellipsis)
+        chunks = batch_slices(len(image), self.reference[0].size * self.reference.itemsize)
+        psnr, ssim = zip(*(self._evaluate(image[chunk], chunk) for chunk in chunks))
+        return np.concatenate(psnr), np.concatenate(ssim)
+
+    def _evaluate(self, image, chunk):
+        from scipy.ndimage import uniform_filter
+
+        reference, ux, ux_squared, vx = self.reference[chunk], self.ux[chunk], self.ux_squared[chunk], self.vx[chunk]
+        keepdims = image.ndim > 2
+        ssim_data_range = image.max(axis=(-2, -1), keepdims=keepdims) - image.min(axis=(-2, -1), keepdims=keepdims)
+        image = downsample(image.astype(np.float64), self.factor)
+
+        image_squared = image * image
+        cross = reference * image
+        uy = uniform_filter(image, size=self.window)
+        uyy = uniform_filter(image_squared, size=self.window)
+        uxy = uniform_filter(cross, size=self.window)
+        C1 = (self.K1 * ssim_data_range) ** 2
+        C2 = (self.K2 * ssim_data_range) ** 2
+
+        # the SSIM terms are built in place over the filter outputs to keep stacks cache resident
+        A1 = ux * uy
+        uy *= uy
+        uyy -= uy
+        uyy *= self.cov_norm
+        B2 = uyy
+        B2 += vx
+        B2 += C2
+        uxy -= A1
+        uxy *= 2 * self.cov_norm
+        A2 = uxy
+        A2 += C2
+        A1 *= 2
+        A1 += C1
+        B1 = uy
+        B1 += ux_squared
+        B1 += C1
+
+        A1 *= A2
+        B1 *= B2
+        A1 /= B1
+        pad = (self.WIN_SIZE - 1) // 2
+        ssim = A1[..., pad:-pad, pad:-pad].mean(axis=(-2, -1), dtype=np.float64)
+
+        mse = np.maximum(self.reference_power[chunk] + np.mean(image_squared, axis=(-2, -1))
+                         - 2 * np.mean(cross, axis=(-2, -1)), 0.0)
+        with np.errstate(divide='ignore'):
+            psnr = 10 * np.log10(self.psnr_data_range[chunk] ** 2 / mse)
+        return psnr, ssim
+
+
+DEFAULT_DENOISING_GRID = {
+    'wavelets': ['bior4.4', 'db4', 'sym4'],
+    'levels': [1, 2],
+    'threshold_factors': [0.1, 0.2],
+    'threshold_modes': ['soft', 'hard'],
+}
+
+def _evaluate(quality, image):
+    with stage('enhance.metrics'):
+        return quality.evaluate(image)
+
+def _evaluate_wavelet_candidate(quality, coeffs, wavelet, threshold_factor, threshold_mode, sigma):
+    with stage('enhance.denoise'):
+        denoised_image = denoise_coeffs(coeffs, wavelet, threshold_factor, threshold_mode, sigma)
+    return denoised_image, *_evaluate(quality, denoised_image)
+
+def _evaluate_nl_means(quality, noisy):
+    with stage('enhance.nl_means'):
+        denoised_image = nl_means_denoising(noisy)
+    return denoised_image, *_evaluate(quality, denoised_image)
+
+def _task(executor, func):
+    # timings are collected per thread context; process pools cannot carry them across
+    return func if isinstance(executor, ProcessPoolExecutor) else bind(func)
+
+def _shortlist(results, top_k):
+    by_psnr = sorted(range(len(results)), key=lambda i: results[i][1], reverse=True)[:top_k]
+    by_ssim = sorted(range(len(results)), key=lambda i: results[i][2], reverse=True)[:top_k]
+    return sorted(set(by_psnr) | set(by_ssim))
+
+def denoising_grid_search(original, noisy, grid=None, executor=None, progress=None, screening=None):
+    grid = {**DEFAULT_DENOISING_GRID, **(grid or {})}
+    candidates = list(product(grid['wavelets'], grid['levels'], grid['threshold_factors'], grid['threshold_modes']))
+    quality = QualityMetrics(original)
+    if screening:
+        screening_quality = QualityMetrics(original, factor=screening.get('factor', 2))
+    else:
+        screening_quality = quality
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor()
+    try:
+        nl_means_future = executor.submit(_task(executor, _evaluate_nl_means), screening_quality, noisy)
+        decomposition_futures = {wavelet: executor.submit(_task(executor, wavelet_decompositions), noisy, wavelet,
+                                                          grid['levels'])
+                                 for wavelet in grid['wavelets']}
+        sigmas = {}
+        futures = []
+        for wavelet, level, threshold_factor, threshold_mode in candidates:
+            coeffs = decomposition_futures[wavelet].result()[level]
+            if (wavelet, level) not in sigmas:
+                sigmas[wavelet, level] = estimate_sigma(coeffs[0])
+            futures.append(executor.submit(_task(executor, _evaluate_wavelet_candidate), screening_quality, coeffs,
+                                           wavelet, threshold_factor, threshold_mode, sigmas[wavelet, level]))
+        futures.append(nl_means_future)
+        if progress is not None:
+            for done, _ in enumerate(as_completed(futures), start=1):
+                progress(done / len(futures))
+        results = [future.result() for future in futures]
+
+        if screening:
+            shortlist = _shortlist(results, screening.get('top_k', 4))
+            exact = dict(zip(shortlist, executor.map(_task(executor, partial(_evaluate, quality)),
+                                                     [results[i][0] for i in shortlist])))
+            results = [(result[0], *exact[i]) if i in exact else (result[0], -np.inf, -np.inf)
+                       for i, result in enumerate(results)]
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    best = {
+        'best_psnr': -np.inf,
+        'best_ssim': -np.inf,
+        'best_params_psnr': None,
+        'best_params_ssim': None,
+        'best_denoised_psnr': None,
+        'best_denoised_ssim': None,
+    }
+    for params, (denoised_image, psnr, ssim) in zip(candidates + [None], results):
+        if psnr > best['best_psnr']:
+            best['best_psnr'] = psnr
+            best['best_denoised_psnr'] = denoised_image
+            if params is not None:
+                best['best_params_psnr'] = params
+
+        if ssim > best['best_ssim']:
+            best['best_ssim'] = ssim
+            best['best_denoised_ssim'] = denoised_image
+            if params is not None:
+                best['best_params_ssim'] = params
+    return best
@@ -1,3 +1,4 @@
+import pywt
 from django import forms
 from .models import UploadedImage
 
@@ -14,3 +15,74 @@ class UploadImageForm(forms.ModelForm):
         model = UploadedImage
         fields = ['image', 'operation']
 
+
+class CompressionForm(forms.Form):
+    TARGETS = [
+        ('', 'Fixed quantization'),
+        ('target_bytes', 'Target size (bytes)'),
+        ('target_ratio', 'Target compression ratio'),
+        ('target_psnr', 'Target PSNR (dB)'),
+    ]
+
+    level = forms.IntegerField(min_value=1, max_value=8, initial=3, label='Decomposition levels')
+    target = forms.ChoiceField(choices=TARGETS, required=False, label='Rate control')
+    target_value = forms.FloatField(required=False, min_value=0)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('target') and not cleaned_data.get('target_value'):
+            raise forms.ValidationError('Give a positive value for the rate control target')
+        return cleaned_data
+
+    def params(self):
+        params = {'level': self.cleaned_data['level']}
+        if self.cleaned_data['target']:
+            params[self.cleaned_data['target']] = self.cleaned_data['target_value']
+        return params
+
+
+class DenoisingGridForm(forms.Form):
+    THRESHOLD_MODES = ('soft', 'hard', 'garrote', 'greater', 'less')
+
+    wavelets = forms.CharField(required=False, help_text='Comma-separated, e.g. bior4.4, db4, sym4')
+    levels = forms.CharField(required=False, help_text='Comma-separated, e.g. 1, 2')
+    threshold_factors = forms.CharField(required=False, help_text='Comma-separated, e.g. 0.1, 0.2')
+    threshold_modes = forms.CharField(required=False, help_text='Comma-separated, e.g. soft, hard')
+
+    def _split(self, field):
+        return [item.strip() for item in self.cleaned_data[field].split(',') if item.strip()]
+
+    def clean_wavelets(self):
+        wavelets = self._split('wavelets')
+        unknown = [wavelet for wavelet in wavelets if wavelet not in pywt.wavelist(kind='discrete')]
+        if unknown:
+            raise forms.ValidationError(f"Unknown wavelets: {', '.join(unknown)}")
+        return wavelets
+
+    def clean_levels(self):
+        try:
+            levels = [int(level) for level in self._split('levels')]
+        except ValueError:
+            raise forms.ValidationError('Levels must be whole numbers')
+        if any(level < 1 for level in levels):
+            raise forms.ValidationError('Levels must be at least 1')
+        return levels
+
+    def clean_threshold_factors(self):
+        try:
+            threshold_factors = [float(factor) for factor in self._split('threshold_factors')]
+        except ValueError:
+            raise forms.ValidationError('Threshold factors must be numbers')
+        if any(factor < 0 for factor in threshold_factors):
+            raise forms.ValidationError('Threshold factors must not be negative')
+        return threshold_factors
+
+    def clean_threshold_modes(self):
+        threshold_modes = self._split('threshold_modes')
+        unknown = [mode for mode in threshold_modes if mode not in self.THRESHOLD_MODES]
+        if unknown:
+            raise forms.ValidationError(f"Unknown threshold modes: {', '.join(unknown)}")
+        return threshold_modes
+
+    def grid(self):
+        return {field: values for field, values in self.cleaned_data.items() if values}
@@ -0,0 +1,22 @@
+import numpy as np
+from PIL import Image
+
+
+def to_float(pixels, dtype=np.float32):
+    return pixels.astype(dtype) / 255
+
+
+def to_uint8(image, vmin=None, vmax=None):
+    image = np.asarray(image, dtype=np.float64)
+    vmin = image.min() if vmin is None else vmin
+    vmax = image.max() if vmax is None else vmax
+    scale = 255 / (vmax - vmin) if vmax > vmin else 0.0
+    return np.round(np.clip((image - vmin) * scale, 0, 255)).astype(np.uint8)
+
+
+def to_pil(image, vmin=None, vmax=None):
+    return Image.fromarray(to_uint8(image, vmin, vmax))
+
+
+def write_image(path, image, vmin=None, vmax=None, **options):
+    to_pil(image, vmin, vmax).save(path, **options)
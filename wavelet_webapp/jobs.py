@@ -0,0 +1,164 @@
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from . import cache as result_cache
+from .artifacts import new_namespace
+from .models import Job
+from .operations import OPERATIONS, result_context
+from .pixels import hash_upload
+from .timing import collect, observe_many, stage
+from .workers import init_worker
+
+logger = logging.getLogger('wavelet_webapp.timing')
+error_logger = logging.getLogger('wavelet_webapp.jobs')
+
+# shown to users in place of job.error, which holds a server traceback for the logs and the admin
+FAILURE_MESSAGE = 'The image could not be processed.'
+
+# an encrypt result owns an EncryptedData row and its key bundle embeds its own namespace,
+# so a copy made for another upload would point decryption at the wrong original
+UNCACHED_OPERATIONS = {'encrypt'}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.WAVELET_JOB_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_worker,
+                initargs=(os.environ['DJANGO_SETTINGS_MODULE'],),
+            )
+        return _executor
+
+
+def _stale_cutoff():
+    return timezone.now() - timedelta(seconds=settings.WAVELET_JOB_TIMEOUT)
+
+
+def live_jobs():
+    return Job.objects.filter(status__in=[Job.PENDING, Job.RUNNING], updated_at__gte=_stale_cutoff())
+
+
+def fail_stale_jobs():
+    # rows left pending or running by a worker that died, or by a web process that restarted
+    # with jobs still queued in its in-memory pool; running jobs refresh updated_at as they progress
+    return Job.objects.filter(status__in=[Job.PENDING, Job.RUNNING], updated_at__lt=_stale_cutoff()).update(
+        status=Job.FAILED, error='Job was lost: no progress within WAVELET_JOB_TIMEOUT', updated_at=timezone.now())
+
+
+def submit_job(uploaded_image, operation, params=None):
+    params = params or {}
+    fail_stale_jobs()
+    if not uploaded_image.sha256:
+        hash_upload(uploaded_image)
+    cache_key = ''
+    cached_result = None
+    if operation not in UNCACHED_OPERATIONS:
+        cache_key = result_cache.make_key(uploaded_image.sha256, operation, params, result_context(operation))
+        cached_result = result_cache.lookup(cache_key, new_namespace(uploaded_image.id))
+    if cached_result is not None:
+        return Job.objects.create(image=uploaded_image, operation=operation, params=params, status=Job.DONE,
+                                  progress=1.0, result=cached_result, cache_key=cache_key)
+
+    job = Job.objects.create(image=uploaded_image, operation=operation, params=params, cache_key=cache_key)
+    if settings.WAVELET_JOB_WORKERS == 0:
+        run_job(job.id)
+        job.refresh_from_db()
+    else:
+        transaction.on_commit(lambda: _queue_job(job.id))
+    return job
+
+
+def _queue_job(job_id):
+    global _executor
+    try:
+        future = get_executor().submit(_run_job_in_worker, job_id)
+    except BrokenProcessPool:
+        # a worker that died took the pool down with it; its jobs were failed by the callback
+        with _executor_lock:
+            _executor = None
+        future = get_executor().submit(_run_job_in_worker, job_id)
+    future.add_done_callback(partial(_record_worker_results, job_id))
+
+
+def _run_job_in_worker(job_id):
+    close_old_connections()
+    before = result_cache.cache_stats()
+    try:
+        observations = run_job(job_id)
+    finally:
+        close_old_connections()
+    after = result_cache.cache_stats()
+    return observations, {name: after[name] - before[name] for name in after}
+
+
+def _record_worker_results(job_id, future):
+    if future.cancelled():
+        error = 'Job was cancelled'
+    elif future.exception() is not None:
+        # run_job records its own failures, so this is the worker process itself dying (e.g. BrokenProcessPool)
+        exception = future.exception()
+        error = ''.join(traceback.format_exception(type(exception), exception, exception.__traceback__))
+    else:
+        observations, cache_counts = future.result()
+        observe_many(observations)
+        result_cache.merge_stats(cache_counts)
+        return
+    error_logger.error('Job %s failed in its worker:\n%s', job_id, error)
+    try:
+        Job.objects.filter(pk=job_id, status__in=[Job.PENDING, Job.RUNNING]).update(
+            status=Job.FAILED, error=error, updated_at=timezone.now())
+    finally:
+        close_old_connections()
+
+
+def run_job(job_id):
+    # a job already failed as stale is not run again
+    if not Job.objects.filter(pk=job_id, status=Job.PENDING).update(status=Job.RUNNING, updated_at=timezone.now()):
+        return []
+    job = Job.objects.select_related('image').get(pk=job_id)
+
+    def progress(fraction):
+        Job.objects.filter(pk=job_id).update(progress=fraction, updated_at=timezone.now())
+
+    with collect() as timings:
+        try:
+            with stage(f'job.{job.operation}'):
+                result = OPERATIONS[job.operation](job.image, job.params, progress)
+        except Exception:
+            job.status = Job.FAILED
+            job.error = traceback.format_exc()
+            error_logger.error('Job %s (%s) failed:\n%s', job.id, job.operation, job.error)
+        else:
+            job.status = Job.DONE
+            job.progress = 1.0
+            job.result = result
+    job.timings = timings.summary()
+    logger.info(json.dumps({'job': job.id, 'operation': job.operation, 'status': job.status,
+                            'stages_ms': {name: round(seconds * 1000, 1) for name, seconds in job.timings.items()}}))
+
+    if job.status == Job.FAILED:
+        job.save(update_fields=['status', 'error', 'timings', 'updated_at'])
+        return timings.observations
+
+    job.save(update_fields=['status', 'progress', 'result', 'timings', 'updated_at'])
+    if job.cache_key:
+        result_cache.store(job.cache_key, job.result)
+    return timings.observations
@@ -0,0 +1,37 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from wavelet_webapp.batch import collect_sources, run_batch
+from wavelet_webapp.operations import OPERATIONS
+
+
+class Command(BaseCommand):
+    help = 'Run an operation over a directory, glob or list of uploaded images, appending metrics to a JSONL file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('operation', choices=sorted(OPERATIONS))
+        parser.add_argument('paths', nargs='*', help='Image files, directories or glob patterns')
+        parser.add_argument('--ids', type=int, nargs='+', default=[], help='UploadedImage ids')
+        parser.add_argument('--output', required=True,
+                            help='JSONL file; images already recorded as done in it are skipped')
+        parser.add_argument('--params', type=json.loads, default={}, help='Operation parameters as JSON')
+        parser.add_argument('--workers', type=int, default=settings.WAVELET_BATCH_WORKERS)
+        parser.add_argument('--chunk-size', type=int, default=settings.WAVELET_BATCH_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        sources = collect_sources(options['paths'], options['ids'])
+        if not sources:
+            raise CommandError('No images to process')
+
+        failed = 0
+        for record in run_batch(sources, options['operation'], options['output'], options['params'],
+                                max_workers=options['workers'], chunk_size=options['chunk_size']):
+            if record['status'] == 'ok':
+                self.stdout.write(f"{record['source']}: ok in {record['seconds']:.2f}s")
+            else:
+                failed += 1
+                self.stderr.write(f"{record['source']}: {record['error'].splitlines()[-1]}")
+        if failed:
+            raise CommandError(f'{failed} images failed; rerun the same command to retry them')
@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from wavelet_webapp.artifacts import sweep_artifacts
+from wavelet_webapp.pixels import sweep_pixels
+
+
+class Command(BaseCommand):
+    help = 'Remove per-upload artifact directories and decoded pixel arrays older than the retention period'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=int, default=settings.WAVELET_ARTIFACT_RETENTION,
+                            help='Retention period in seconds')
+
+    def handle(self, *args, **options):
+        removed = sweep_artifacts(options['max_age'])
+        removed_pixels = sweep_pixels(options['max_age'])
+        self.stdout.write(f'Removed {removed} artifact directories and {removed_pixels} pixel arrays')
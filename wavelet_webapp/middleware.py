@@ -0,0 +1,82 @@
+import cProfile
+import io
+import json
+import logging
+import pstats
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse
+
+from .timing import collect, server_timing, stage
+
+logger = logging.getLogger('wavelet_webapp.timing')
+
+
+class StageTimingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if settings.WAVELET_PROFILING_ENABLED and 'profile' in request.GET:
+            return self.profile(request)
+
+        with collect() as timings:
+            with stage('request'):
+                response = self.get_response(request)
+        return self.finish(request, response, timings)
+
+    async def __acall__(self, request):
+        if settings.WAVELET_PROFILING_ENABLED and 'profile' in request.GET:
+            return await self.aprofile(request)
+
+        with collect() as timings:
+            with stage('request'):
+                response = await self.get_response(request)
+        return self.finish(request, response, timings)
+
+    def finish(self, request, response, timings):
+        summary = timings.summary()
+        summary.update(getattr(response, 'job_timings', {}))
+        response['Server-Timing'] = server_timing(summary)
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'stages_ms': {name: round(seconds * 1000, 1) for name, seconds in summary.items()},
+        }))
+        return response
+
+    def profile(self, request):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            self.get_response(request)
+        finally:
+            profiler.disable()
+        return self.profile_report(request, profiler)
+
+    async def aprofile(self, request):
+        # only covers code running on the event loop thread, not work handed to executors
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await self.get_response(request)
+        finally:
+            profiler.disable()
+        return self.profile_report(request, profiler)
+
+    def profile_report(self, request, profiler):
+        sort_key = request.GET['profile']
+        if sort_key not in pstats.Stats.sort_arg_dict_default:
+            sort_key = 'cumulative'
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats(sort_key).print_stats(50)
+        return HttpResponse(report.getvalue(), content_type='text/plain')
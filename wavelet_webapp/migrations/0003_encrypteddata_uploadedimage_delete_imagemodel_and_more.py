@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wavelet_webapp', '0002_imagemodel_delete_uploadedimage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EncryptedData',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('encrypted_image', models.ImageField(upload_to='encrypted/')),
+                ('npz_file', models.FileField(upload_to='npz/')),
+                ('uploaded_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UploadedImage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('image', models.ImageField(upload_to='images/')),
+                ('uploaded_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.DeleteModel(
+            name='ImageModel',
+        ),
+        migrations.AddField(
+            model_name='encrypteddata',
+            name='image',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='wavelet_webapp.uploadedimage'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wavelet_webapp', '0003_encrypteddata_uploadedimage_delete_imagemodel_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='uploadedimage',
+            name='image',
+            field=models.FileField(upload_to='uploads/'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wavelet_webapp', '0005_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='cache_key',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wavelet_webapp', '0006_job_cache_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='timings',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -3,9 +3,38 @@ from django.db import models
 class UploadedImage(models.Model):
     image = models.FileField(upload_to='uploads/')
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    sha256 = models.CharField(max_length=64, blank=True)
+    mode = models.CharField(max_length=3, blank=True)
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    dtype = models.CharField(max_length=16, blank=True)
 
 class EncryptedData(models.Model):
     image = models.ForeignKey(UploadedImage, on_delete=models.CASCADE)
     encrypted_image = models.ImageField(upload_to='encrypted/')
     npz_file = models.FileField(upload_to='npz/')
     uploaded_at = models.DateTimeField(auto_now_add=True)
+
+class Job(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    image = models.ForeignKey(UploadedImage, on_delete=models.CASCADE)
+    operation = models.CharField(max_length=20)
+    params = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    progress = models.FloatField(default=0.0)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    cache_key = models.CharField(max_length=64, blank=True)
+    timings = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
@@ -0,0 +1,250 @@
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+from django.urls import reverse
+from PIL import Image
+
+from .artifacts import atomic_path, media_path, media_url, new_namespace
+from .bitstream import VERSION, open_bitstream, write_bitstream
+from .compression import (compress_image, compress_to_target, decompress_image, calculate_compression_ratio,
+                          calculate_psnr)
+from .encryption import chaotic_wavelet_encrypt
+from .image_io import to_float, to_pil, write_image
+from .enhancement import add_gaussian_noise, denoising_grid_search
+from .models import EncryptedData
+from .pixels import open_pixels
+from .timing import stage
+from .tiling import TILED_VERSION, compress_tiled, decompress_tiled, strip_psnr
+
+
+def _no_progress(fraction):
+    pass
+
+
+def encrypt_uploaded_image(uploaded_image, params, progress=_no_progress):
+    with stage('upload.decode'):
+        image = to_float(open_pixels(uploaded_image, 'L'), np.float32)
+    progress(0.1)
+
+    key = {'x0': 0.5, 'r': 3.9, 'wavelet': 'haar', 'level': 1, 'mode': 'periodization'}
+    encrypted_image = chaotic_wavelet_encrypt(image, **key)
+    progress(0.8)
+
+    namespace = new_namespace(uploaded_image.id)
+    original_image_name = f'{namespace}/original_image.npy'
+    encrypted_image_name = f'{namespace}/encrypted_image.png'
+    npz_file_name = f'{namespace}/encrypted_data.npz'
+
+    with stage('artifacts.write'):
+        with atomic_path(original_image_name) as original_image_path:
+            np.save(original_image_path, image)
+
+        with atomic_path(encrypted_image_name) as encrypted_image_path:
+            write_image(encrypted_image_path, encrypted_image)
+
+        with atomic_path(npz_file_name) as npz_file_path:
+            np.savez(npz_file_path, encrypted_image=encrypted_image.astype(np.float32),
+                     shape=np.array(image.shape), namespace=namespace, **key)
+
+    encrypted_data = EncryptedData.objects.create(
+        image=uploaded_image,
+        encrypted_image=encrypted_image_name,
+        npz_file=npz_file_name
+    )
+
+    return {
+        'encrypted_data_id': encrypted_data.id,
+        'encrypted_image_url': encrypted_data.encrypted_image.url,
+        'npz_file_url': reverse('download_artifact', args=[npz_file_name]),
+        'artifacts': [original_image_name, encrypted_image_name, npz_file_name],
+    }
+
+
+RATE_TARGETS = ('target_bytes', 'target_ratio', 'target_psnr')
+
+
+def compress_uploaded_image(uploaded_image, params, progress=_no_progress):
+    level = int(params.get('level', 3))
+    targets = {name: float(params[name]) for name in RATE_TARGETS if params.get(name) is not None}
+
+    with stage('upload.decode'):
+        original_array = open_pixels(uploaded_image)
+    if original_array.shape[0] * original_array.shape[1] >= settings.WAVELET_TILED_MIN_PIXELS:
+        return compress_large_image(original_array, level, new_namespace(uploaded_image.id), progress, targets)
+    progress(0.1)
+
+    rate_control = None
+    if targets:
+        bitstream, original_size, compressed_size, rate_control = compress_to_target(
+            original_array, level=level, **targets)
+    else:
+        bitstream, original_size, compressed_size = compress_image(original_array, level=level)
+    progress(0.5)
+
+    namespace = new_namespace(uploaded_image.id)
+    bitstream_name = f'{namespace}/compressed_image.wlt'
+    decompressed_image_name = f'{namespace}/decompressed_image.png'
+
+    with stage('artifacts.write'), atomic_path(bitstream_name) as bitstream_path:
+        write_bitstream(bitstream_path, bitstream)
+
+    with open_bitstream(media_path(bitstream_name)) as mapped_bitstream:
+        decompressed_image = decompress_image(mapped_bitstream)
+    progress(0.8)
+
+    with stage('png.encode'), atomic_path(decompressed_image_name) as decompressed_image_path:
+        decompressed_image.save(decompressed_image_path)
+
+    compression_ratio = calculate_compression_ratio(original_size, compressed_size)
+    with stage('compress.psnr'):
+        psnr_value = calculate_psnr(original_array, np.array(decompressed_image))
+
+    return {
+        'decompressed_image_path': media_url(decompressed_image_name),
+        'bitstream_path': reverse('download_artifact', args=[bitstream_name]),
+        'preview_path': reverse('compressed_preview', args=[bitstream_name]),
+        'original_size': original_size,
+        'compressed_size': compressed_size,
+        'compression_ratio': compression_ratio,
+        'psnr_value': psnr_value,
+        'rate_control': rate_control,
+        'artifacts': [bitstream_name, decompressed_image_name],
+    }
+
+
+def compress_large_image(original_array, level, namespace, progress=_no_progress, targets=None):
+    bitstream_name = f'{namespace}/compressed_image.wltt'
+    decompressed_image_name = f'{namespace}/decompressed_image.png'
+
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        progress(0.1)
+        rate_control = None
+        options = {}
+        if targets:
+            # pick the factor on the central tile; a byte target becomes the equivalent ratio
+            if 'target_bytes' in targets:
+                targets = {'target_ratio': original_array.nbytes / targets['target_bytes']}
+            tile_size = settings.WAVELET_TILE_SIZE
+            top = max(0, (original_array.shape[0] - tile_size) // 2)
+            left = max(0, (original_array.shape[1] - tile_size) // 2)
+            sample = np.array(original_array[top:top + tile_size, left:left + tile_size])
+            rate_control = compress_to_target(sample, level=level, **targets)[3]
+            rate_control['estimated_size'] = int(rate_control['estimated_size'] * original_array.nbytes / sample.nbytes)
+            options['quantization_factor'] = rate_control['quantization_factor']
+        with stage('compress.tiled'), atomic_path(bitstream_name) as bitstream_path:
+            original_size, compressed_size = compress_tiled(
+                original_array, bitstream_path, tile_size=settings.WAVELET_TILE_SIZE,
+                overlap=settings.WAVELET_TILE_OVERLAP, max_workers=settings.WAVELET_TILE_WORKERS, level=level,
+                **options)
+        progress(0.5)
+
+        decompressed_array = np.lib.format.open_memmap(os.path.join(scratch_dir, 'decompressed.npy'), mode='w+',
+                                                       dtype=np.uint8, shape=original_array.shape)
+        with stage('decompress.tiled'):
+            decompress_tiled(media_path(bitstream_name), out=decompressed_array,
+                             max_workers=settings.WAVELET_TILE_WORKERS)
+        progress(0.8)
+        with stage('png.encode'), atomic_path(decompressed_image_name) as decompressed_image_path:
+            Image.fromarray(decompressed_array).save(decompressed_image_path)
+
+        with stage('compress.psnr'):
+            psnr_value = strip_psnr(original_array, decompressed_array)
+        del original_array, decompressed_array
+
+    return {
+        'decompressed_image_path': media_url(decompressed_image_name),
+        'bitstream_path': reverse('download_artifact', args=[bitstream_name]),
+        'preview_path': reverse('compressed_preview', args=[bitstream_name]),
+        'original_size': original_size,
+        'compressed_size': compressed_size,
+        'compression_ratio': calculate_compression_ratio(original_size, compressed_size),
+        'psnr_value': psnr_value,
+        'rate_control': rate_control,
+        'artifacts': [bitstream_name, decompressed_image_name],
+    }
+
+
+def denoising_executor():
+    if settings.WAVELET_DENOISING_POOL == 'process':
+        return ProcessPoolExecutor(max_workers=settings.WAVELET_DENOISING_WORKERS,
+                                   mp_context=multiprocessing.get_context('spawn'))
+    return ThreadPoolExecutor(max_workers=settings.WAVELET_DENOISING_WORKERS)
+
+
+def enhance_uploaded_image(uploaded_image, params, progress=_no_progress):
+    with stage('upload.decode'):
+        image_float = to_float(open_pixels(uploaded_image, 'L'), np.float64)
+
+    noisy_image = add_gaussian_noise(image_float, mean=0, var=0.01)
+    progress(0.05)
+
+    grid = {**settings.WAVELET_DENOISING_GRID, **params.get('grid', {})}
+    with denoising_executor() as executor:
+        best = denoising_grid_search(image_float, noisy_image, grid, executor=executor,
+                                     progress=lambda fraction: progress(0.05 + 0.85 * fraction),
+                                     screening=settings.WAVELET_DENOISING_SCREENING)
+    best_denoised_psnr = best.pop('best_denoised_psnr')
+    # the results page compares the noisy input with the best-PSNR result only
+    del best['best_denoised_ssim']
+
+    namespace = new_namespace(uploaded_image.id)
+    images = {
+        'noisy_image': noisy_image,
+        'best_denoised_psnr': best_denoised_psnr,
+    }
+    result = {'artifacts': []}
+    for name, image in images.items():
+        with stage('png.encode'):
+            artifacts = save_preview(image, f'{namespace}/{name}')
+        result[f'{name}_url'] = reverse('artifact_file', args=[artifacts[0]])
+        result[f'{name}_thumbnail_url'] = reverse('artifact_file', args=[artifacts[-1]])
+        result['artifacts'].extend(artifacts)
+    return {**result, **best}
+
+
+def save_preview(image, name):
+    preview = to_pil(image, vmin=0, vmax=1)
+    artifacts = [f'{name}.png']
+    with atomic_path(artifacts[0]) as path:
+        preview.save(path, compress_level=1)
+
+    if settings.WAVELET_THUMBNAIL_SIZE and max(preview.size) > settings.WAVELET_THUMBNAIL_SIZE:
+        preview.thumbnail((settings.WAVELET_THUMBNAIL_SIZE, settings.WAVELET_THUMBNAIL_SIZE))
+        artifacts.append(f'{name}_thumbnail.png')
+        with atomic_path(artifacts[1]) as path:
+            preview.save(path)
+    return artifacts
+
+
+OPERATIONS = {
+    'encrypt': encrypt_uploaded_image,
+    'compress': compress_uploaded_image,
+    'enhance': enhance_uploaded_image,
+}
+
+# what a result depends on besides the upload and the request params; it is hashed into the
+# result cache key so a configuration change or a format bump is a miss, not a stale hit
+RESULT_SETTINGS = {
+    'compress': ('WAVELET_TILED_MIN_PIXELS', 'WAVELET_TILE_SIZE', 'WAVELET_TILE_OVERLAP'),
+    'enhance': ('WAVELET_DENOISING_GRID', 'WAVELET_DENOISING_SCREENING', 'WAVELET_THUMBNAIL_SIZE'),
+}
+FORMAT_VERSIONS = {
+    'compress': {'bitstream': VERSION, 'tiled': TILED_VERSION},
+}
+
+
+def result_context(operation):
+    context = {name: getattr(settings, name) for name in RESULT_SETTINGS.get(operation, ())}
+    context.update(FORMAT_VERSIONS.get(operation, {}))
+    return context
+
+
+SUCCESS_TEMPLATES = {
+    'encrypt': 'wavelet_webapp/encryption_success.html',
+    'compress': 'wavelet_webapp/compression_success.html',
+    'enhance': 'wavelet_webapp/enhancement_success.html',
+}
@@ -0,0 +1,104 @@
+import os
+import shutil
+import time
+from contextlib import ExitStack
+
+import numpy as np
+from PIL import Image
+
+from .artifacts import atomic_path, media_path
+from .cache import file_digest
+from .timing import stage
+
+PIXELS_DIR = 'pixels'
+STRIP_BYTES = 1 << 24
+
+
+def pixels_name(digest, mode):
+    return f'{PIXELS_DIR}/{digest}/{mode}.npy'
+
+
+def _scale_to_8bit(image):
+    # convert() clips 16-bit and float greyscale to 0..255 instead of scaling it
+    pixels = np.asarray(image)
+    top = float(pixels.max(initial=0))
+    top = max(top, 1.0 if image.mode == 'F' else 65535.0)
+    return Image.fromarray(np.round(np.clip(pixels, 0, None) * (255 / top)).astype(np.uint8), 'L')
+
+
+def _decode(image_path, digest):
+    with Image.open(image_path) as image:
+        if image.mode.startswith(('I', 'F')):
+            image = _scale_to_8bit(image)
+        if image.mode not in ('L', 'RGB'):
+            image = image.convert('RGB')
+        # Pillow decodes the whole frame on first access; converting strip by strip only
+        # bounds the L/RGB conversion buffers. L is renamed into place last, so once it
+        # exists the RGB array does too
+        image.load()
+        modes = ('L',) if image.mode == 'L' else ('L', 'RGB')
+        with ExitStack() as stack:
+            arrays = {}
+            for mode in modes:
+                path = stack.enter_context(atomic_path(pixels_name(digest, mode)))
+                shape = (image.height, image.width) + ((3,) if mode == 'RGB' else ())
+                arrays[mode] = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=shape)
+            strip_height = max(1, STRIP_BYTES // (image.width * len(image.getbands())))
+            for top in range(0, image.height, strip_height):
+                strip = image.crop((0, top, image.width, min(top + strip_height, image.height)))
+                for mode, array in arrays.items():
+                    array[top:top + strip.height] = np.asarray(strip if strip.mode == mode else strip.convert(mode))
+            for array in arrays.values():
+                array.flush()
+        return image.mode
+
+
+def hash_upload(uploaded_image):
+    with stage('upload.hash'):
+        uploaded_image.sha256 = file_digest(uploaded_image.image.path)
+    uploaded_image.save(update_fields=['sha256'])
+    return uploaded_image
+
+
+def ingest(uploaded_image):
+    with stage('upload.ingest'):
+        digest = uploaded_image.sha256 or file_digest(uploaded_image.image.path)
+        if os.path.exists(media_path(pixels_name(digest, 'L'))):
+            mode = 'RGB' if os.path.exists(media_path(pixels_name(digest, 'RGB'))) else 'L'
+        else:
+            mode = _decode(uploaded_image.image.path, digest)
+        pixels = np.load(media_path(pixels_name(digest, mode)), mmap_mode='r')
+
+    uploaded_image.sha256 = digest
+    uploaded_image.mode = mode
+    uploaded_image.height, uploaded_image.width = pixels.shape[:2]
+    uploaded_image.dtype = pixels.dtype.name
+    uploaded_image.save(update_fields=['sha256', 'mode', 'height', 'width', 'dtype'])
+    return uploaded_image
+
+
+def open_pixels(uploaded_image, mode=None):
+    if (not uploaded_image.sha256 or not uploaded_image.mode
+            or not os.path.exists(media_path(pixels_name(uploaded_image.sha256, 'L')))):
+        ingest(uploaded_image)
+    path = media_path(pixels_name(uploaded_image.sha256, mode or uploaded_image.mode))
+    os.utime(os.path.dirname(path))
+    return np.load(path, mmap_mode='r')
+
+
+def sweep_pixels(max_age):
+    # arrays are decoded again on demand, so any that went unused for max_age can go
+    root = media_path(PIXELS_DIR)
+    if not os.path.isdir(root):
+        return 0
+    cutoff = time.time() - max_age
+    removed = 0
+    for entry in os.scandir(root):
+        try:
+            last_used = entry.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        if entry.is_dir() and last_used < cutoff:
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed += 1
+    return removed
@@ -1,3 +1,689 @@
-from django.test import TestCase
+import io
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from . import async_views, cache as result_cache, pixels as pixels_module
+from .artifacts import ARTIFACTS_DIR, atomic_path, media_path, media_url, new_namespace, sweep_artifacts
+from .batch import process_source
+from .bitstream import (COLORSPACE_YCBCR, MAGIC, VERSION, BitstreamError, decode_bitstream, decode_bitstreams,
+                        read_layout, scale_for_budget, varint_decode, varint_encode, varint_encode_many,
+                        write_bitstream, zigzag_decode, zigzag_encode)
+from .compression import (PSNR_CEILING_MARGIN, calculate_psnr, compress_batch, compress_image, compress_to_target,
+                          decompress_batch, decompress_image, entropy_decode, entropy_encode, preview_scale)
+from .encryption import chaotic_permutation, chaotic_wavelet_decrypt, chaotic_wavelet_encrypt
+from .enhancement import (DEFAULT_DENOISING_GRID, QualityMetrics, _shortlist, compute_psnr, compute_ssim,
+                          denoise_coeffs, denoising_grid_search, wavelet_decompositions)
+from .image_io import to_float
+from .jobs import FAILURE_MESSAGE, _record_worker_results, fail_stale_jobs, live_jobs, run_job, submit_job
+from .models import EncryptedData, Job, UploadedImage
+from .operations import FORMAT_VERSIONS, encrypt_uploaded_image, result_context
+from .pixels import hash_upload, open_pixels, pixels_name, sweep_pixels
+from .views import decrypt_upload
+
+
+def _ramp(height, width, seed=0):
+    rng = np.random.default_rng(seed)
+    rows, cols = np.mgrid[0:height, 0:width]
+    image = 128 + 60 * np.sin(rows / 7) * np.cos(cols / 11) + rng.normal(0, 4, (height, width))
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+def _colour(height, width, seed=0):
+    return np.dstack([_ramp(height, width, seed + c) for c in range(3)])
+
+def _legacy_entropy_encode(data):
+    # the original per-element loop the vectorized codec replaced
+    encoded = []
+    previous_value = data[0]
+    count = 1
+    for value in data[1:]:
+        if value == previous_value:
+            count += 1
+        else:
+            encoded.append((previous_value, count))
+            previous_value = value
+            count = 1
+    encoded.append((previous_value, count))
+    return encoded
+
+def _uploaded_image(pixels, name='image.png'):
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, 'PNG')
+    uploaded_image = UploadedImage()
+    uploaded_image.image.save(name, ContentFile(buffer.getvalue()))
+    return hash_upload(uploaded_image)
+
+def _npz_upload(**arrays):
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return SimpleUploadedFile('encrypted_data.npz', buffer.getvalue())
+
+def _read_media_png(url):
+    with Image.open(media_path(url[len(settings.MEDIA_URL):])) as image:
+        return np.asarray(image)
+
+def _use_temporary_media(test):
+    media_root = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+    media_settings = override_settings(MEDIA_ROOT=media_root)
+    media_settings.enable()
+    test.addCleanup(media_settings.disable)
+    return media_root
+
+
+class EntropyCodingTests(SimpleTestCase):
+    def test_matches_legacy_codec(self):
+        rng = np.random.default_rng(0)
+        for data in (np.array([7]), np.full(50, -3), np.array([1, 1, 2, 2, 2, 1, 0, 0, 5]),
+                     rng.integers(-2, 3, 1000), np.repeat(rng.integers(-50, 50, 200), rng.integers(1, 9, 200))):
+            with self.subTest(data=data[:10]):
+                values, run_lengths = entropy_encode(data)
+                self.assertEqual(list(zip(values.tolist(), run_lengths.tolist())),
+                                 [(int(value), count) for value, count in _legacy_entropy_encode(data)])
+                np.testing.assert_array_equal(entropy_decode((values, run_lengths)), data)
+
+    def test_empty_input(self):
+        values, run_lengths = entropy_encode(np.array([], dtype=np.int64))
+        self.assertEqual((values.size, run_lengths.size), (0, 0))
+        self.assertEqual(entropy_decode((values, run_lengths)).size, 0)
+
+    def test_flattens_subbands(self):
+        subband = np.array([[0, 0, 1], [1, 1, 0]])
+        values, run_lengths = entropy_encode(subband)
+        np.testing.assert_array_equal(values, [0, 1, 0])
+        np.testing.assert_array_equal(run_lengths, [2, 3, 1])
+        np.testing.assert_array_equal(entropy_decode((values, run_lengths)), subband.ravel())
+
+
+class VarintTests(SimpleTestCase):
+    def test_round_trip(self):
+        values = np.array([0, 1, 127, 128, 300, 16383, 16384, 2 ** 35, 2 ** 64 - 1], dtype=np.uint64)
+        np.testing.assert_array_equal(varint_decode(varint_encode(values).tobytes()), values)
+
+    def test_zigzag_round_trip(self):
+        values = np.array([0, -1, 1, -64, 64, -(2 ** 40), 2 ** 40], dtype=np.int64)
+        np.testing.assert_array_equal(zigzag_decode(zigzag_encode(values)), values)
+
+    def test_truncated_stream(self):
+        with self.assertRaises(BitstreamError):
+            varint_decode(varint_encode(np.array([300], dtype=np.uint64)).tobytes()[:1])
+
+
+class BitstreamTests(SimpleTestCase):
+    def setUp(self):
+        self.gray = _ramp(45, 61)
+        self.bitstream = compress_image(self.gray, wavelet='db2', quantization_factor=4, level=2)[0]
+
+    def test_header(self):
+        header, channels = decode_bitstream(self.bitstream)
+        self.assertEqual(self.bitstream[:4], MAGIC)
+        self.assertEqual(self.bitstream[4], VERSION)
+        self.assertEqual(header['shape'], (45, 61))
+        self.assertEqual(header['wavelet'], 'db2')
+        self.assertEqual(header['level'], 2)
+        self.assertEqual(header['quantization_factor'], 4)
+        self.assertEqual(len(channels), 1)
+        self.assertEqual(len(channels[0][1]), 7)
+
+    def test_gray_round_trip(self):
+        decompressed = np.asarray(decompress_image(self.bitstream))
+        self.assertEqual(decompressed.shape, self.gray.shape)
+        self.assertGreater(calculate_psnr(self.gray, decompressed), 35)
+
+    def test_colour_round_trip(self):
+        image = _colour(40, 52)
+        bitstream = compress_image(image, quantization_factor=4, level=2)[0]
+        header, channels = decode_bitstream(bitstream)
+        self.assertEqual(header['colorspace'], COLORSPACE_YCBCR)
+        self.assertEqual([channel_shape for channel_shape, _, _ in channels], [(40, 52), (20, 26), (20, 26)])
+        decompressed = np.asarray(decompress_image(bitstream))
+        self.assertEqual(decompressed.shape, image.shape)
+        self.assertGreater(calculate_psnr(image, decompressed), 30)
+
+    def test_truncated_header(self):
+        for length in (0, 3, 8, 20):
+            with self.assertRaises(BitstreamError):
+                decode_bitstream(self.bitstream[:length])
+
+    def test_truncated_payload(self):
+        with self.assertRaises(BitstreamError):
+            decode_bitstream(self.bitstream[:-1])
+
+    def test_bad_magic(self):
+        with self.assertRaisesMessage(BitstreamError, 'Not a wavelet bitstream'):
+            decode_bitstream(b'XXXX' + self.bitstream[4:])
+
+    def test_bad_version(self):
+        with self.assertRaisesMessage(BitstreamError, 'Unsupported bitstream version'):
+            decode_bitstream(self.bitstream[:4] + bytes([VERSION + 1]) + self.bitstream[5:])
+
+    def test_corrupt_subband_payload(self):
+        _, tables, layout = read_layout(self.bitstream)
+        c, index, _, offset = layout[0]
+        end = offset + sum(tables[c][1][index][3:])
+        corrupt = bytearray(self.bitstream)
+        # the final run length byte always ends a varint, so flipping its low bit keeps the stream
+        # well formed but changes the run total
+        corrupt[end - 1] ^= 1
+        with self.assertRaisesMessage(BitstreamError, 'Corrupt subband payload'):
+            decode_bitstream(bytes(corrupt))
+
+
+class ProgressiveDecodingTests(SimpleTestCase):
+    def setUp(self):
+        self.gray = _ramp(45, 61)
+        self.bitstream = compress_image(self.gray, wavelet='db2', quantization_factor=4, level=2)[0]
+
+    def test_reduced_scale_decodes_a_prefix(self):
+        _, tables, layout = read_layout(self.bitstream)
+        coarse_end = max(offset + sum(tables[c][1][index][3:]) for c, index, scale, offset in layout if scale == 4)
+        decompressed = np.asarray(decompress_image(self.bitstream[:coarse_end], scale=4))
+        self.assertEqual(decompressed.shape, (12, 16))
+        with self.assertRaises(BitstreamError):
+            decompress_image(self.bitstream[:coarse_end], scale=2)
+
+    def test_scale_for_budget(self):
+        self.assertEqual(scale_for_budget(self.bitstream, len(self.bitstream)), 1)
+        self.assertEqual(scale_for_budget(self.bitstream, 0), 4)
+
+    def test_preview_scale(self):
+        self.assertEqual(preview_scale((1000, 600), 256), 4)
+        self.assertEqual(preview_scale((200, 100), 256), 1)
+        self.assertEqual(preview_scale((1000, 600), None), 1)
+
+    def test_preview_view(self):
+        _use_temporary_media(self)
+        name = f'{new_namespace(1)}/image.wlt'
+        with atomic_path(name) as path:
+            write_bitstream(path, self.bitstream)
+        for thumbnail_size, query, size in ((16, '', (16, 12)), (None, '', (61, 45)), (None, '?scale=2', (31, 23))):
+            with self.subTest(thumbnail_size=thumbnail_size, query=query), \
+                    override_settings(WAVELET_THUMBNAIL_SIZE=thumbnail_size):
+                response = self.client.get(reverse('compressed_preview', args=[name]) + query)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(Image.open(io.BytesIO(response.content)).size, size)
+
+
+class BatchTests(SimpleTestCase):
+    def test_encode_many_matches_separate_encodes(self):
+        streams = [np.array([1, 200, 70000], dtype=np.uint64), np.array([], dtype=np.uint64),
+                   np.array([5, 2 ** 50], dtype=np.uint64)]
+        for encoded, stream in zip(varint_encode_many(streams), streams):
+            np.testing.assert_array_equal(encoded, varint_encode(stream))
+
+    def test_compress_batch_matches_compress_image(self):
+        for images in (np.stack([_ramp(33, 47, seed) for seed in range(3)]),
+                       np.stack([_colour(32, 40, seed) for seed in range(3)])):
+            batch = compress_batch(images, wavelet='db2', quantization_factor=6, level=2)
+            for image, result in zip(images, batch):
+                self.assertEqual(result, compress_image(image, wavelet='db2', quantization_factor=6, level=2))
+
+    def test_decompress_batch_matches_decompress_image(self):
+        images = np.stack([_colour(32, 40, seed) for seed in range(3)])
+        bitstreams = [bitstream for bitstream, _, _ in compress_batch(images, quantization_factor=6, level=2)]
+        decompressed = decompress_batch(bitstreams)
+        for bitstream, image in zip(bitstreams, decompressed):
+            np.testing.assert_array_equal(image, np.asarray(decompress_image(bitstream)))
+
+    def test_decode_bitstreams_matches_decode_bitstream(self):
+        images = np.stack([_ramp(33, 47, seed) for seed in range(2)])
+        bitstreams = [bitstream for bitstream, _, _ in compress_batch(images, level=2)]
+        header, channels = decode_bitstreams(bitstreams)
+        singles = [decode_bitstream(bitstream) for bitstream in bitstreams]
+        self.assertEqual(header, singles[0][0])
+        for i, (values, run_lengths, shape) in enumerate(channels[0][1]):
+            single_subbands = [single[1][0][1][i] for single in singles]
+            np.testing.assert_array_equal(values, np.concatenate([subband[0] for subband in single_subbands]))
+            np.testing.assert_array_equal(run_lengths, np.concatenate([subband[1] for subband in single_subbands]))
+            self.assertEqual(shape, single_subbands[0][2])
+
+    def test_decode_bitstreams_rejects_mixed_layouts(self):
+        first = compress_image(_ramp(33, 47), quantization_factor=6)[0]
+        for other in (compress_image(_ramp(33, 47), quantization_factor=8)[0],
+                      compress_image(_ramp(33, 48), quantization_factor=6)[0]):
+            with self.assertRaisesMessage(BitstreamError, 'Bitstreams do not share one layout'):
+                decode_bitstreams([first, other])
+
+    def test_decode_bitstreams_rejects_corrupt_stream(self):
+        bitstream = compress_image(_ramp(33, 47))[0]
+        _, tables, layout = read_layout(bitstream)
+        c, index, _, offset = layout[0]
+        corrupt = bytearray(bitstream)
+        corrupt[offset + sum(tables[c][1][index][3:]) - 1] ^= 1
+        with self.assertRaisesMessage(BitstreamError, 'Corrupt subband payload'):
+            decode_bitstreams([bitstream, bytes(corrupt)])
+
+    def test_decode_bitstreams_rejects_truncated_stream(self):
+        bitstream = compress_image(_ramp(33, 47))[0]
+        with self.assertRaisesMessage(BitstreamError, 'Truncated bitstream'):
+            decode_bitstreams([bitstream, bitstream[:-1]])
+
+
+class QualityMetricsTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(11)
+        rows, cols = np.mgrid[0:72, 0:80]
+        self.original = 0.5 + 0.4 * np.sin(cols / 9.0) * np.cos(rows / 7.0)
+        self.noisy = self.original + rng.normal(0, 0.1, self.original.shape)
+        self.candidates = []
+        for wavelet in DEFAULT_DENOISING_GRID['wavelets']:
+            decompositions = wavelet_decompositions(self.noisy, wavelet, DEFAULT_DENOISING_GRID['levels'])
+            for level in DEFAULT_DENOISING_GRID['levels']:
+                for threshold_factor in DEFAULT_DENOISING_GRID['threshold_factors']:
+                    for threshold_mode in DEFAULT_DENOISING_GRID['threshold_modes']:
+                        self.candidates.append(denoise_coeffs(decompositions[level], wavelet, threshold_factor,
+                                                              threshold_mode)[:72, :80])
+
+    def test_matches_skimage(self):
+        quality = QualityMetrics(self.original)
+        for candidate in self.candidates + [self.noisy]:
+            psnr, ssim = quality.evaluate(candidate)
+            self.assertAlmostEqual(psnr, compute_psnr(self.original, candidate), delta=1e-9)
+            self.assertAlmostEqual(ssim, compute_ssim(self.original, candidate), delta=1e-12)
+
+    def test_stack_matches_single_images(self):
+        quality = QualityMetrics(np.stack([self.original] * 3))
+        stack = np.stack(self.candidates[:3])
+        psnr, ssim = quality.evaluate(stack)
+        for i, candidate in enumerate(stack):
+            single_psnr, single_ssim = QualityMetrics(self.original).evaluate(candidate)
+            self.assertAlmostEqual(psnr[i], single_psnr, delta=1e-9)
+            self.assertAlmostEqual(ssim[i], single_ssim, delta=1e-12)
+
+    def test_screening_keeps_the_exact_winner(self):
+        exact = QualityMetrics(self.original)
+        screening = QualityMetrics(self.original, factor=2)
+        scores = np.array([exact.evaluate(candidate) for candidate in self.candidates])
+        shortlist = _shortlist([(candidate, *screening.evaluate(candidate)) for candidate in self.candidates], 4)
+        self.assertIn(int(np.argmax(scores[:, 0])), shortlist)
+        self.assertIn(int(np.argmax(scores[:, 1])), shortlist)
+
+    def test_screened_grid_search_finds_the_same_winner(self):
+        exact = denoising_grid_search(self.original, self.noisy)
+        screened = denoising_grid_search(self.original, self.noisy, screening={'factor': 2, 'top_k': 4})
+        for key in ('best_params_psnr', 'best_params_ssim'):
+            self.assertEqual(screened[key], exact[key])
+        self.assertAlmostEqual(screened['best_psnr'], exact['best_psnr'], delta=1e-9)
+        self.assertAlmostEqual(screened['best_ssim'], exact['best_ssim'], delta=1e-12)
+
+
+class KeyBundleDecryptionTests(TestCase):
+    def setUp(self):
+        _use_temporary_media(self)
+        self.image = to_float(_ramp(48, 64), np.float64)
+
+    def test_key_only_bundle(self):
+        key = {'x0': 0.31, 'r': 3.97, 'wavelet': 'haar', 'level': 2}
+        encrypted_image = chaotic_wavelet_encrypt(self.image, **key)
+        self.assertFalse(np.allclose(encrypted_image[:48, :64], self.image, atol=0.05))
+        result = decrypt_upload(_npz_upload(encrypted_image=encrypted_image, **key))
+        self.assertIsNone(result['psnr_value'])
+        np.testing.assert_array_equal(_read_media_png(result['decrypted_image_path']), _ramp(48, 64))
+
+    def test_legacy_permuted_indices_bundle(self):
+        encrypted_image = chaotic_wavelet_encrypt(self.image, x0=0.5, r=3.9)
+        permuted_indices = np.array(chaotic_permutation((48, 64), 0.5, 3.9), dtype=np.int64)
+        decrypted_image = chaotic_wavelet_decrypt(encrypted_image, permuted_indices=permuted_indices)
+        np.testing.assert_allclose(decrypted_image, self.image, atol=1e-9)
+        result = decrypt_upload(_npz_upload(encrypted_image=encrypted_image, permuted_indices=permuted_indices))
+        np.testing.assert_array_equal(_read_media_png(result['decrypted_image_path']), _ramp(48, 64))
+
+
+class PeriodizationEncryptionTests(TestCase):
+    def test_odd_shapes_round_trip(self):
+        for shape, wavelet, level in (((45, 61), 'haar', 1), ((33, 32), 'db2', 2), ((17, 50), 'bior4.4', 3)):
+            with self.subTest(shape=shape, wavelet=wavelet, level=level):
+                image = to_float(_ramp(*shape), np.float64)
+                key = {'x0': 0.37, 'r': 3.91, 'wavelet': wavelet, 'level': level, 'mode': 'periodization'}
+                encrypted_image = chaotic_wavelet_encrypt(image, **key)
+                self.assertEqual(encrypted_image.shape, tuple(-(-size // 2 ** level) * 2 ** level for size in shape))
+                decrypted_image = chaotic_wavelet_decrypt(encrypted_image, shape=shape, **key)
+                self.assertEqual(decrypted_image.shape, shape)
+                np.testing.assert_allclose(decrypted_image, image, atol=1e-9)
+
+    def test_encrypt_job_bundle_round_trip(self):
+        _use_temporary_media(self)
+        pixels = _ramp(45, 61)
+        uploaded_image = _uploaded_image(pixels)
+        result = encrypt_uploaded_image(uploaded_image, {})
+        npz_file = EncryptedData.objects.get(pk=result['encrypted_data_id']).npz_file
+        with open(npz_file.path, 'rb') as f:
+            decrypted = decrypt_upload(SimpleUploadedFile('encrypted_data.npz', f.read()))
+        # the job works in float32, so the reconstruction is exact to float32 precision
+        self.assertGreater(decrypted['psnr_value'], 120)
+        np.testing.assert_array_equal(_read_media_png(decrypted['decrypted_image_path']), pixels)
+
+
+@override_settings(WAVELET_JOB_WORKERS=0, WAVELET_CACHE_ENABLED=False, WAVELET_JOB_TIMEOUT=60)
+class JobTests(TestCase):
+    def setUp(self):
+        _use_temporary_media(self)
+        self.uploaded_image = _uploaded_image(_ramp(32, 48))
+
+    def test_inline_job_runs_to_completion(self):
+        job = submit_job(self.uploaded_image, 'compress', {'wavelet': 'haar', 'quantization_factor': 10, 'level': 2})
+        self.assertEqual(job.status, Job.DONE)
+        self.assertEqual(job.progress, 1.0)
+        self.assertIn('job.compress', job.timings)
+
+    def test_dead_worker_fails_the_job(self):
+        job = Job.objects.create(image=self.uploaded_image, operation='compress', status=Job.RUNNING)
+        future = Future()
+        future.set_exception(BrokenProcessPool('A process in the process pool was terminated abruptly'))
+        with self.assertLogs('wavelet_webapp.jobs', 'ERROR'):
+            _record_worker_results(job.id, future)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertIn('BrokenProcessPool', job.error)
+
+    def test_stale_jobs_are_failed(self):
+        stale = Job.objects.create(image=self.uploaded_image, operation='compress')
+        Job.objects.filter(pk=stale.pk).update(updated_at=timezone.now() - timedelta(seconds=120))
+        live = Job.objects.create(image=self.uploaded_image, operation='compress', status=Job.RUNNING)
+        self.assertEqual(list(live_jobs()), [live])
+        self.assertEqual(fail_stale_jobs(), 1)
+        stale.refresh_from_db()
+        live.refresh_from_db()
+        self.assertEqual((stale.status, live.status), (Job.FAILED, Job.RUNNING))
+
+    def test_failure_hides_the_traceback(self):
+        job = Job.objects.create(image=self.uploaded_image, operation='compress', params={'level': 'x'})
+        with self.assertLogs('wavelet_webapp.jobs', 'ERROR') as logs:
+            run_job(job.id)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertIn('Traceback', job.error)
+        self.assertIn('Traceback', logs.output[0])
+        status = self.client.get(reverse('job_status', args=[job.id])).json()
+        self.assertEqual(status['error'], FAILURE_MESSAGE)
+        page = self.client.get(reverse('job_detail', args=[job.id]))
+        self.assertContains(page, FAILURE_MESSAGE)
+        self.assertNotContains(page, 'Traceback')
+
+    def test_failed_job_is_not_run(self):
+        job = Job.objects.create(image=self.uploaded_image, operation='compress', status=Job.FAILED)
+        self.assertEqual(run_job(job.id), [])
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+
+
+@override_settings(WAVELET_MAX_PENDING_JOBS=2, WAVELET_JOB_TIMEOUT=60)
+class BackpressureTests(TransactionTestCase):
+    def setUp(self):
+        _use_temporary_media(self)
+        self.uploaded_image = _uploaded_image(_ramp(32, 48))
+
+    def _encrypt(self):
+        request = RequestFactory().post('/')
+        return async_to_sync(async_views.encrypt_image)(request, self.uploaded_image.id)
+
+    def test_live_jobs_get_a_429(self):
+        for _ in range(2):
+            Job.objects.create(image=self.uploaded_image, operation='encrypt', status=Job.RUNNING)
+        response = self._encrypt()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], str(settings.WAVELET_RETRY_AFTER))
+
+    @override_settings(WAVELET_JOB_WORKERS=0)
+    def test_stale_jobs_do_not_hold_the_queue(self):
+        for _ in range(2):
+            Job.objects.create(image=self.uploaded_image, operation='encrypt')
+        Job.objects.update(updated_at=timezone.now() - timedelta(seconds=120))
+        response = self._encrypt()
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Job.objects.filter(status=Job.FAILED).count(), 2)
+        self.assertEqual(Job.objects.filter(status=Job.DONE).count(), 1)
+
+
+class MetricsViewTests(TestCase):
+    def test_restricted_to_staff(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        user = User.objects.create_user('viewer', password='secret')
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        user.is_staff = True
+        user.save()
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.json()), {'stages', 'cache'})
+
+
+@override_settings(WAVELET_CACHE_ENABLED=True)
+class ResultCacheTests(TestCase):
+    def setUp(self):
+        _use_temporary_media(self)
+
+    def _store(self, key, size=1000):
+        name = f'{new_namespace(1)}/artifact.bin'
+        with atomic_path(name) as path, open(path, 'wb') as f:
+            f.write(bytes(size))
+        result_cache.store(key, {'url': media_url(name), 'artifacts': [name]})
+        return name
+
+    def test_lookup_links_artifacts_into_the_new_namespace(self):
+        before = result_cache.cache_stats()
+        self.assertIsNone(result_cache.lookup('a' * 64, new_namespace(2)))
+        name = self._store('a' * 64)
+        namespace = new_namespace(2)
+        result = result_cache.lookup('a' * 64, namespace)
+        renamed = f'{namespace}/artifact.bin'
+        self.assertEqual(result, {'url': media_url(renamed), 'artifacts': [renamed]})
+        self.assertTrue(os.path.samefile(media_path(renamed), media_path(name)))
+        after = result_cache.cache_stats()
+        self.assertEqual({stat: after[stat] - before[stat] for stat in after},
+                         {'hits': 1, 'misses': 1, 'stores': 1, 'evictions': 0})
+
+    def test_evicts_least_recently_used_entries(self):
+        keys = [character * 64 for character in 'abc']
+        for age, key in zip((300, 200, 100), keys):
+            self._store(key)
+            result_path = os.path.join(result_cache._entry_dir(key), 'result.json')
+            os.utime(result_path, (time.time() - age, time.time() - age))
+        result_cache.evict(2500)
+        self.assertEqual([os.path.isdir(result_cache._entry_dir(key)) for key in keys], [False, True, True])
+
+    def test_key_covers_settings_and_format_versions(self):
+        key = result_cache.make_key('0' * 64, 'compress', {}, result_context('compress'))
+        with override_settings(WAVELET_TILE_SIZE=512):
+            self.assertNotEqual(result_cache.make_key('0' * 64, 'compress', {}, result_context('compress')), key)
+        with mock.patch.dict(FORMAT_VERSIONS['compress'], bitstream=VERSION + 1):
+            self.assertNotEqual(result_cache.make_key('0' * 64, 'compress', {}, result_context('compress')), key)
+        enhance_key = result_cache.make_key('0' * 64, 'enhance', {}, result_context('enhance'))
+        with override_settings(WAVELET_DENOISING_SCREENING={'factor': 2, 'top_k': 4}):
+            self.assertNotEqual(result_cache.make_key('0' * 64, 'enhance', {}, result_context('enhance')), enhance_key)
+
+    @override_settings(WAVELET_JOB_WORKERS=0)
+    def test_repeat_job_is_served_from_the_cache(self):
+        uploaded_image = _uploaded_image(_ramp(32, 48))
+        first = submit_job(uploaded_image, 'compress', {'level': 2})
+        second = submit_job(uploaded_image, 'compress', {'level': 2})
+        self.assertEqual(first.cache_key, second.cache_key)
+        self.assertEqual(second.timings, {})
+        self.assertNotEqual(first.result['artifacts'], second.result['artifacts'])
+        self.assertEqual(first.result['compressed_size'], second.result['compressed_size'])
+        with override_settings(WAVELET_TILE_SIZE=512):
+            third = submit_job(uploaded_image, 'compress', {'level': 2})
+        self.assertNotEqual(third.cache_key, first.cache_key)
+        self.assertIn('job.compress', third.timings)
+
+
+class BatchSourceTests(TestCase):
+    def setUp(self):
+        self.media_root = _use_temporary_media(self)
+        self.source_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.source_dir, ignore_errors=True)
+
+    def test_records_carry_per_image_timings(self):
+        source = os.path.join(self.source_dir, 'ramp.png')
+        Image.fromarray(_ramp(32, 48)).save(source)
+        record = process_source(source, 'compress', {'level': 2})
+        self.assertEqual(record['status'], 'ok')
+        self.assertIn('upload.decode', record['timings'])
+        self.assertIn('compress.threshold', record['timings'])
+        self.assertEqual(UploadedImage.objects.get().id, record['upload_id'])
+
+    def test_failed_file_sources_leave_no_uploads(self):
+        source = os.path.join(self.source_dir, 'broken.png')
+        with open(source, 'wb') as f:
+            f.write(b'not an image')
+        for _ in range(2):
+            record = process_source(source, 'compress', {})
+            self.assertEqual(record['status'], 'error')
+            self.assertIn('timings', record)
+        self.assertFalse(UploadedImage.objects.exists())
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'uploads')), [])
+
+    def test_failed_upload_sources_are_kept(self):
+        uploaded_image = _uploaded_image(_ramp(32, 48))
+        record = process_source(f'upload:{uploaded_image.id}', 'compress', {'level': 'x'})
+        self.assertEqual((record['status'], record['upload_id']), ('error', uploaded_image.id))
+        self.assertTrue(UploadedImage.objects.filter(pk=uploaded_image.id).exists())
+
+
+class RateControlTests(SimpleTestCase):
+    def setUp(self):
+        self.images = {'gray': _ramp(128, 160), 'colour': _colour(128, 160)}
+
+    def _psnr(self, image, bitstream):
+        return calculate_psnr(image, np.asarray(decompress_image(bitstream)))
+
+    def test_byte_target_is_met(self):
+        for name, image in self.images.items():
+            for targets in ({'target_bytes': image.nbytes / 8}, {'target_ratio': 4}):
+                with self.subTest(image=name, **targets):
+                    target_bytes = targets.get('target_bytes') or image.nbytes / targets['target_ratio']
+                    bitstream, _, compressed_size, rate_control = compress_to_target(image, level=2, **targets)
+                    self.assertTrue(rate_control['target_met'])
+                    self.assertEqual(compressed_size, len(bitstream))
+                    self.assertLessEqual(compressed_size, target_bytes)
+                    self.assertGreater(compressed_size, 0.9 * target_bytes)
+
+    def test_psnr_target_is_met(self):
+        for name, image in self.images.items():
+            with self.subTest(image=name):
+                bitstream, _, _, rate_control = compress_to_target(image, level=2, target_psnr=35)
+                self.assertTrue(rate_control['target_met'])
+                self.assertGreaterEqual(self._psnr(image, bitstream), 35 - 0.05)
+                self.assertLess(self._psnr(image, bitstream), 35 + 0.5)
+
+    def test_unreachable_psnr_is_clamped_below_the_ceiling(self):
+        for name, image in self.images.items():
+            with self.subTest(image=name):
+                finest = compress_image(image, quantization_factor=0.05, level=2)[0]
+                bitstream, _, _, rate_control = compress_to_target(image, level=2, target_psnr=200)
+                self.assertFalse(rate_control['target_met'])
+                self.assertGreater(rate_control['quantization_factor'], 1)
+                self.assertGreater(self._psnr(image, bitstream), self._psnr(image, finest) - 2 * PSNR_CEILING_MARGIN)
+                self.assertLess(len(bitstream), 0.8 * len(finest))
+
+    def test_needs_exactly_one_target(self):
+        with self.assertRaises(ValueError):
+            compress_to_target(self.images['gray'])
+        with self.assertRaises(ValueError):
+            compress_to_target(self.images['gray'], target_bytes=1000, target_psnr=30)
+
+
+class ArtifactTests(SimpleTestCase):
+    def setUp(self):
+        self.media_root = _use_temporary_media(self)
+
+    def test_atomic_path_replaces_on_success_only(self):
+        name = f'{new_namespace(1)}/result.bin'
+        with atomic_path(name) as path:
+            with open(path, 'wb') as f:
+                f.write(b'first')
+            self.assertFalse(os.path.exists(media_path(name)))
+        with self.assertRaises(RuntimeError), atomic_path(name) as path:
+            with open(path, 'wb') as f:
+                f.write(b'partial')
+            raise RuntimeError
+        with open(media_path(name), 'rb') as f:
+            self.assertEqual(f.read(), b'first')
+        self.assertEqual(os.listdir(os.path.dirname(media_path(name))), ['result.bin'])
+
+    def test_namespaces_are_unique_per_call(self):
+        self.assertNotEqual(new_namespace(1), new_namespace(1))
+        self.assertTrue(new_namespace(7).startswith(f'{ARTIFACTS_DIR}/7/'))
+
+    def test_sweep_removes_only_expired_namespaces(self):
+        old, fresh = new_namespace(1), new_namespace(1)
+        for namespace in (old, fresh):
+            with atomic_path(f'{namespace}/image.png') as path, open(path, 'wb') as f:
+                f.write(b'png')
+        expired = time.time() - 3600
+        for path in (media_path(f'{old}/image.png'), media_path(old)):
+            os.utime(path, (expired, expired))
+        self.assertEqual(sweep_artifacts(60), 1)
+        self.assertFalse(os.path.exists(media_path(old)))
+        self.assertTrue(os.path.exists(media_path(f'{fresh}/image.png')))
+        self.assertEqual(sweep_artifacts(60), 0)
+
+
+class PixelStoreTests(TestCase):
+    def setUp(self):
+        _use_temporary_media(self)
+
+    def test_decodes_once_per_digest(self):
+        pixels = _colour(40, 52)
+        first = _uploaded_image(pixels, 'first.png')
+        second = _uploaded_image(pixels, 'second.png')
+        self.assertEqual(first.sha256, second.sha256)
+        with mock.patch('wavelet_webapp.pixels._decode', wraps=pixels_module._decode) as decode:
+            rgb = open_pixels(first)
+            gray = open_pixels(second, 'L')
+        self.assertEqual(decode.call_count, 1)
+        self.assertIsInstance(rgb, np.memmap)
+        np.testing.assert_array_equal(rgb, pixels)
+        self.assertEqual(gray.shape, (40, 52))
+        second.refresh_from_db()
+        self.assertEqual((second.mode, second.height, second.width, second.dtype), ('RGB', 40, 52, 'uint8'))
+
+    def test_sweep_and_reingest(self):
+        uploaded_image = _uploaded_image(_ramp(32, 48))
+        open_pixels(uploaded_image)
+        directory = os.path.dirname(media_path(pixels_name(uploaded_image.sha256, 'L')))
+        self.assertEqual(sweep_pixels(60), 0)
+        expired = time.time() - 3600
+        os.utime(directory, (expired, expired))
+        self.assertEqual(sweep_pixels(60), 1)
+        self.assertFalse(os.path.exists(directory))
+        np.testing.assert_array_equal(open_pixels(uploaded_image), _ramp(32, 48))
+        self.assertTrue(os.path.exists(directory))
+
+    def test_deep_greyscale_is_scaled_not_clipped(self):
+        for array, name, image_format in (
+                (np.tile(np.linspace(0, 65535, 64), (8, 1)).astype(np.uint16), 'deep.png', 'PNG'),
+                (np.tile(np.linspace(0, 1, 64), (8, 1)).astype(np.float32), 'float.tif', 'TIFF')):
+            with self.subTest(name=name):
+                buffer = io.BytesIO()
+                Image.fromarray(array).save(buffer, image_format)
+                uploaded_image = UploadedImage()
+                uploaded_image.image.save(name, ContentFile(buffer.getvalue()))
+                pixels = open_pixels(hash_upload(uploaded_image), 'L')
+                self.assertEqual((int(pixels.min()), int(pixels.max())), (0, 255))
+                self.assertAlmostEqual(float(pixels.mean()) / 255, 0.5, delta=0.01)
+
+    def test_open_refreshes_the_retention_clock(self):
+        uploaded_image = _uploaded_image(_ramp(32, 48))
+        open_pixels(uploaded_image)
+        directory = os.path.dirname(media_path(pixels_name(uploaded_image.sha256, 'L')))
+        expired = time.time() - 3600
+        os.utime(directory, (expired, expired))
+        open_pixels(uploaded_image)
+        self.assertEqual(sweep_pixels(60), 0)
@@ -0,0 +1,161 @@
+import mmap
+import multiprocessing
+import os
+import struct
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from .bitstream import BitstreamError, scale_for_budget
+from .compression import compress_image, decompress_image
+
+TILED_MAGIC = b'WLTT'
+TILED_VERSION = 1
+
+_HEADER = struct.Struct('<4sBB')
+_TILING = struct.Struct('<II')
+_TILE = struct.Struct('<IIIIIIQQ')
+_COUNT = struct.Struct('<I')
+_TRAILER = struct.Struct('<Q')
+
+
+def iter_tiles(shape, tile_size, overlap):
+    height, width = shape[:2]
+    for top in range(0, height, tile_size):
+        for left in range(0, width, tile_size):
+            core_height = min(tile_size, height - top)
+            core_width = min(tile_size, width - left)
+            outer_top = max(0, top - overlap)
+            outer_left = max(0, left - overlap)
+            outer_bottom = min(height, top + core_height + overlap)
+            outer_right = min(width, left + core_width + overlap)
+            yield (top, left, core_height, core_width,
+                   top - outer_top, left - outer_left, outer_bottom - outer_top, outer_right - outer_left)
+
+def _compress_tile(tile_array, options):
+    bitstream, _, _ = compress_image(tile_array, max_workers=1, **options)
+    return bytes(bitstream)
+
+def _decompress_tile(bitstream):
+    return np.asarray(decompress_image(bitstream, max_workers=1))
+
+def _process_pool(max_workers):
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+def _bounded_map(executor, func, jobs, max_in_flight):
+    pending = deque()
+    for key, args in jobs:
+        pending.append((key, executor.submit(func, *args)))
+        if len(pending) >= max_in_flight:
+            key, future = pending.popleft()
+            yield key, future.result()
+    while pending:
+        key, future = pending.popleft()
+        yield key, future.result()
+
+
+def compress_tiled(image_array, output_path, tile_size=1024, overlap=16, max_workers=None, **options):
+    tiles = list(iter_tiles(image_array.shape, tile_size, overlap))
+
+    def tile_jobs():
+        for tile in tiles:
+            top, left, _, _, pad_top, pad_left, outer_height, outer_width = tile
+            outer_top, outer_left = top - pad_top, left - pad_left
+            tile_array = np.ascontiguousarray(
+                image_array[outer_top:outer_top + outer_height, outer_left:outer_left + outer_width])
+            yield tile, (tile_array, options)
+
+    max_workers = max_workers or os.cpu_count()
+    index = []
+    with open(output_path, 'wb') as f, _process_pool(max_workers) as executor:
+        shape = image_array.shape
+        f.write(_HEADER.pack(TILED_MAGIC, TILED_VERSION, len(shape)))
+        f.write(struct.pack(f'<{len(shape)}I', *shape))
+        f.write(_TILING.pack(tile_size, overlap))
+
+        for tile, bitstream in _bounded_map(executor, _compress_tile, tile_jobs(), 2 * max_workers):
+            index.append(_TILE.pack(*tile[:6], f.tell(), len(bitstream)))
+            f.write(bitstream)
+
+        index_offset = f.tell()
+        f.write(_COUNT.pack(len(index)))
+        f.writelines(index)
+        f.write(_TRAILER.pack(index_offset))
+        compressed_size = f.tell()
+
+    return image_array.nbytes, compressed_size
+
+def read_tiled_header(buffer):
+    view = memoryview(buffer).cast('B')
+    if view.nbytes < _HEADER.size + _TRAILER.size:
+        raise BitstreamError('Tiled bitstream is too short')
+    magic, version, ndim = _HEADER.unpack_from(view, 0)
+    if magic != TILED_MAGIC:
+        raise BitstreamError('Not a tiled wavelet bitstream')
+    if version != TILED_VERSION:
+        raise BitstreamError(f'Unsupported tiled bitstream version {version}')
+    shape = struct.unpack_from(f'<{ndim}I', view, _HEADER.size)
+    tile_size, overlap = _TILING.unpack_from(view, _HEADER.size + 4 * ndim)
+
+    (index_offset,) = _TRAILER.unpack_from(view, view.nbytes - _TRAILER.size)
+    (n_tiles,) = _COUNT.unpack_from(view, index_offset)
+    tiles = [_TILE.unpack_from(view, index_offset + _COUNT.size + i * _TILE.size) for i in range(n_tiles)]
+
+    header = {'shape': shape, 'tile_size': tile_size, 'overlap': overlap}
+    return header, tiles
+
+def decompress_tiled(input_path, out=None, max_workers=None):
+    with open(input_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        header, tiles = read_tiled_header(mapped)
+        if out is None:
+            out = np.empty(header['shape'], dtype=np.uint8)
+
+        def tile_jobs():
+            for tile in tiles:
+                offset, length = tile[6:]
+                yield tile, (mapped[offset:offset + length],)
+
+        max_workers = max_workers or os.cpu_count()
+        with _process_pool(max_workers) as executor:
+            for tile, tile_array in _bounded_map(executor, _decompress_tile, tile_jobs(), 2 * max_workers):
+                top, left, core_height, core_width, pad_top, pad_left = tile[:6]
+                out[top:top + core_height, left:left + core_width] = \
+                    tile_array[pad_top:pad_top + core_height, pad_left:pad_left + core_width]
+    return out
+
+def preview_tiled(input_path, scale=1, max_bytes=None):
+    with open(input_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        header, tiles = read_tiled_header(mapped)
+        view = memoryview(mapped)
+        try:
+            if max_bytes is not None:
+                total = sum(tile[7] for tile in tiles)
+                for tile in tiles:
+                    offset, length = tile[6:]
+                    scale = max(scale, scale_for_budget(view[offset:offset + length], max_bytes * length // total))
+
+            height, width = (-(-size // scale) for size in header['shape'][:2])
+            out = np.zeros((height, width) + tuple(header['shape'][2:]), dtype=np.uint8)
+            for top, left, core_height, core_width, pad_top, pad_left, offset, length in tiles:
+                tile_array = np.asarray(decompress_image(view[offset:offset + length], max_workers=1, scale=scale))
+                top, left, pad_top, pad_left = top // scale, left // scale, pad_top // scale, pad_left // scale
+                core_height = min(-(-core_height // scale), height - top, tile_array.shape[0] - pad_top)
+                core_width = min(-(-core_width // scale), width - left, tile_array.shape[1] - pad_left)
+                out[top:top + core_height, left:left + core_width] = \
+                    tile_array[pad_top:pad_top + core_height, pad_left:pad_left + core_width]
+        finally:
+            view.release()
+    return Image.fromarray(out)
+
+def strip_psnr(original_image, decompressed_image, strip_height=256):
+    squared_error = 0.0
+    for top in range(0, original_image.shape[0], strip_height):
+        difference = (original_image[top:top + strip_height].astype(float)
+                      - decompressed_image[top:top + strip_height].astype(float))
+        squared_error += np.sum(difference ** 2)
+    mse = squared_error / original_image.size
+    if mse == 0:
+        return float('inf')
+    return 20 * np.log10(255.0 / np.sqrt(mse))
@@ -0,0 +1,93 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+_current = ContextVar('wavelet_stage_timings', default=None)
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+
+class StageTimings:
+    def __init__(self):
+        self.observations = []
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.observations.append((name, seconds))
+
+    def summary(self):
+        totals = {}
+        with self._lock:
+            for name, seconds in self.observations:
+                totals[name] = totals.get(name, 0.0) + seconds
+        return totals
+
+
+def observe(name, seconds):
+    with _histograms_lock:
+        histogram = _histograms.setdefault(name, {'count': 0, 'total': 0.0, 'buckets': [0] * (len(BUCKETS) + 1)})
+        histogram['count'] += 1
+        histogram['total'] += seconds
+        histogram['buckets'][bisect.bisect_left(BUCKETS, seconds)] += 1
+
+
+def observe_many(observations):
+    for name, seconds in observations:
+        observe(name, seconds)
+
+
+def metrics_snapshot():
+    with _histograms_lock:
+        return {
+            name: {
+                'count': histogram['count'],
+                'total': histogram['total'],
+                'mean': histogram['total'] / histogram['count'],
+                'buckets': dict(zip([str(bound) for bound in BUCKETS] + ['+Inf'], histogram['buckets'])),
+            }
+            for name, histogram in sorted(_histograms.items())
+        }
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        timings = _current.get()
+        if timings is not None:
+            timings.add(name, seconds)
+        observe(name, seconds)
+
+
+@contextmanager
+def collect():
+    timings = StageTimings()
+    token = _current.set(timings)
+    try:
+        yield timings
+    finally:
+        _current.reset(token)
+
+
+def bind(func):
+    timings = _current.get()
+
+    def run(*args, **kwargs):
+        token = _current.set(timings)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current.reset(token)
+    return run
+
+
+def server_timing(summary):
+    return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in summary.items())
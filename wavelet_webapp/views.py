@@ -1,29 +1,45 @@
+import json
+import mmap
+import re
+import uuid
+
 from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_POST
 from django.shortcuts import render, redirect
-from django.shortcuts import render
+from django.urls import reverse
+from django.utils.cache import patch_cache_control
 import numpy as np
-import matplotlib.pyplot as plt
-import PIL.Image
-import base64
-from io import BytesIO
-from .enhancement import nl_means_denoising, compute_psnr, compute_ssim, wavelet_denoising, add_gaussian_noise
-from .models import UploadedImage, EncryptedData
-from .forms import UploadImageForm
-from .encryption import chaotic_wavelet_encrypt, chaotic_wavelet_decrypt, resize_image, psnr
-from .compression import compress_image, decompress_image, calculate_compression_ratio, calculate_psnr
-from skimage import io, img_as_float
+from .models import EncryptedData, UploadedImage, Job
+from .forms import CompressionForm, DenoisingGridForm, UploadImageForm
+from .batch import collect_sources, get_executor as get_batch_executor, run_batch
+from .bitstream import BitstreamError, open_bitstream, read_layout
+from .arrays import load_arrays
+from .artifacts import ARTIFACTS_DIR, atomic_path, media_path, media_url, new_namespace
+from .encryption import chaotic_wavelet_decrypt, resize_image, psnr
+from .image_io import write_image
+from .cache import cache_stats
+from .compression import decompress_image, preview_scale
+from .jobs import FAILURE_MESSAGE, fail_stale_jobs, submit_job
+from .operations import OPERATIONS, SUCCESS_TEMPLATES
+from .pixels import hash_upload
+from .tiling import preview_tiled, read_tiled_header
+from .timing import metrics_snapshot, stage
 import os
-from PIL import Image
 
 
 def home_view(request):
     return redirect('upload_image')
 
+def save_upload(form):
+    return hash_upload(form.save())
+
+
 def upload_image(request):
     if request.method == 'POST':
         form = UploadImageForm(request.POST, request.FILES)
         if form.is_valid():
-            uploaded_image = form.save()
+            uploaded_image = save_upload(form)
             operation = form.cleaned_data['operation']
             if operation == 'encrypt':
                 return redirect('encrypt_image', uploaded_image_id=uploaded_image.id)
@@ -40,65 +56,51 @@ def encrypt_image(request, uploaded_image_id):
     uploaded_image = UploadedImage.objects.get(pk=uploaded_image_id)
 
     if request.method == 'POST':
-        image_path = uploaded_image.image.path
-        image = plt.imread(image_path)
-
-        if image.ndim == 3:
-            r, g, b = image[:, :, 0], image[:, :, 1], image[:, :, 2]
-            image = (0.299 * r + 0.587 * g + 0.114 * b).astype(np.float32)
-
-        encrypted_image, permuted_indices = chaotic_wavelet_encrypt(image)
-
-        encrypted_image = resize_image(encrypted_image, image.shape)
-
-        original_image_path = os.path.join(settings.MEDIA_ROOT, 'original', 'original_image.npy')
-        os.makedirs(os.path.dirname(original_image_path), exist_ok=True)
-        np.save(original_image_path, image)
-
-        encrypted_image_path = os.path.join(settings.MEDIA_ROOT, 'encrypted', 'encrypted_image.png')
-        os.makedirs(os.path.dirname(encrypted_image_path), exist_ok=True)
-        plt.imsave(encrypted_image_path, encrypted_image, cmap='gray')
+        job = submit_job(uploaded_image, 'encrypt')
+        return redirect('job_detail', job_id=job.id)
 
-        npz_file_path = os.path.join(settings.MEDIA_ROOT, 'npz', 'encrypted_data.npz')
-        os.makedirs(os.path.dirname(npz_file_path), exist_ok=True)
-        np.savez_compressed(npz_file_path, encrypted_image=encrypted_image.astype(np.float32),
-                            permuted_indices=permuted_indices)
-
-        encrypted_data = EncryptedData.objects.create(
-            image=uploaded_image,
-            encrypted_image='encrypted/encrypted_image.png',
-            npz_file='npz/encrypted_data.npz'
-        )
+    return render(request, 'wavelet_webapp/encrypt_image.html', {'uploaded_image': uploaded_image})
 
-        return render(request, 'wavelet_webapp/encryption_success.html', {'encrypted_data': encrypted_data})
 
-    return render(request, 'wavelet_webapp/encrypt_image.html', {'uploaded_image': uploaded_image})
+def decrypt_upload(npz_file):
+    with stage('upload.decode'):
+        data = load_arrays(npz_file)
+    encrypted_image = data['encrypted_image']
+    if 'permuted_indices' in data:
+        key = {'permuted_indices': data['permuted_indices']}
+    else:
+        key = {'x0': float(data['x0']), 'r': float(data['r']), 'wavelet': str(data['wavelet']),
+               'level': int(data['level'])}
+    if 'mode' in data:
+        key.update(mode=str(data['mode']), shape=tuple(int(size) for size in data['shape']))
+    namespace = str(data['namespace']) if 'namespace' in data else None
+
+    decrypted_image = chaotic_wavelet_decrypt(encrypted_image, **key)
+
+    encrypted_data = EncryptedData.objects.filter(npz_file=f'{namespace}/encrypted_data.npz').first()
+    owner = encrypted_data.image_id if encrypted_data else 'decrypted'
+    decrypted_image_name = f'{new_namespace(owner)}/decrypted_image.png'
+    with stage('png.encode'), atomic_path(decrypted_image_name) as decrypted_image_path:
+        write_image(decrypted_image_path, decrypted_image, vmin=0, vmax=1)
+
+    psnr_value = None
+    if encrypted_data:
+        original_image_path = media_path(f'{namespace}/original_image.npy')
+        if os.path.exists(original_image_path):
+            with stage('decrypt.psnr'):
+                original_image = np.load(original_image_path, mmap_mode='r')
+                if decrypted_image.shape != original_image.shape:
+                    # files written before the shape-preserving mode need resampling
+                    decrypted_image = resize_image(decrypted_image, original_image.shape)
+                psnr_value = psnr(original_image, decrypted_image, data_range=1.0)
+
+    return {'decrypted_image_path': media_url(decrypted_image_name), 'psnr_value': psnr_value}
 
 
 def decrypt_image(request):
     if request.method == 'POST':
-        npz_file = request.FILES['npz_file']
-        with np.load(npz_file) as data:
-            encrypted_image = data['encrypted_image']
-            permuted_indices = data['permuted_indices']
-
-        decrypted_image = chaotic_wavelet_decrypt(encrypted_image, permuted_indices)
-
-        decrypted_image_path = os.path.join(settings.MEDIA_ROOT, 'decrypted', 'decrypted_image.png')
-        os.makedirs(os.path.dirname(decrypted_image_path), exist_ok=True)
-        plt.imsave(decrypted_image_path, decrypted_image, cmap='gray')
-
-        original_image_path = os.path.join(settings.MEDIA_ROOT, 'original', 'original_image.npy')
-        original_image = np.load(original_image_path)
-
-        decrypted_image = resize_image(decrypted_image, original_image.shape)
-
-        psnr_value = psnr(original_image, decrypted_image)
-
-        decrypted_image_url = os.path.join(settings.MEDIA_URL, 'decrypted', 'decrypted_image.png')
-
-        return render(request, 'wavelet_webapp/decryption_success.html',
-                      {'decrypted_image_path': decrypted_image_url, 'psnr_value': psnr_value})
+        context = decrypt_upload(request.FILES['npz_file'])
+        return render(request, 'wavelet_webapp/decryption_success.html', context)
 
     return render(request, 'wavelet_webapp/decrypt_image.html')
 
@@ -107,107 +109,154 @@ def compress_image_view(request, uploaded_image_id):
     uploaded_image = UploadedImage.objects.get(pk=uploaded_image_id)
 
     if request.method == 'POST':
-        image_path = uploaded_image.image.path
-
-        rgb_image = Image.open(image_path)
-        grayscale_image = np.array(rgb_image)
-        original_array = np.array(grayscale_image)
-
-        encoded_coeffs, wavelet_coeffs, original_size, compressed_size = compress_image(original_array)
-
-        decompressed_image = decompress_image(encoded_coeffs, wavelet_coeffs, original_array.shape)
-
-        decompressed_image_path = os.path.join(settings.MEDIA_ROOT, 'decompressed', 'decompressed_image.png')
-        os.makedirs(os.path.dirname(decompressed_image_path), exist_ok=True)
-        decompressed_image.save(decompressed_image_path)
-
-        compression_ratio = calculate_compression_ratio(original_size, compressed_size)
-        psnr_value = calculate_psnr(original_array, np.array(decompressed_image))
-
-        decompressed_image_url = os.path.join(settings.MEDIA_URL, 'decompressed', 'decompressed_image.png')
-
-        return render(request, 'wavelet_webapp/compression_success.html', {
-            'decompressed_image_path': decompressed_image_url,
-            'compression_ratio': compression_ratio,
-            'psnr_value': psnr_value,
-        })
+        form = CompressionForm(request.POST)
+        if form.is_valid():
+            job = submit_job(uploaded_image, 'compress', form.params())
+            return redirect('job_detail', job_id=job.id)
+    else:
+        form = CompressionForm()
 
-    return render(request, 'wavelet_webapp/compress_image.html', {'uploaded_image': uploaded_image})
+    return render(request, 'wavelet_webapp/compress_image.html', {'uploaded_image': uploaded_image, 'form': form})
 
 
 def process_image(request, uploaded_image_id):
     uploaded_image = UploadedImage.objects.get(pk=uploaded_image_id)
-    if request.method == 'POST':
-        image_path = uploaded_image.image.path
-
-
-        image = PIL.Image.open(image_path).convert('L')
-        image_float = img_as_float(np.array(image))
-
-        noisy_image = add_gaussian_noise(image_float, mean=0, var=0.01)
-
-        wavelets = ['bior4.4', 'db4', 'sym4']
-        levels = [1, 2]
-        threshold_factors = [0.1, 0.2]
-        threshold_modes = ['soft', 'hard']
-
-        best_psnr = -np.inf
-        best_ssim = -np.inf
-        best_params_psnr = None
-        best_params_ssim = None
-        best_denoised_psnr = None
-        best_denoised_ssim = None
-
-        for wavelet in wavelets:
-            for level in levels:
-                for threshold_factor in threshold_factors:
-                    for threshold_mode in threshold_modes:
-                        denoised_image = wavelet_denoising(noisy_image, wavelet=wavelet, level=level,
-                                                               threshold_factor=threshold_factor,
-                                                               threshold_mode=threshold_mode)
-                        psnr = compute_psnr(image_float, denoised_image)
-                        ssim = compute_ssim(image_float, denoised_image)
-
-                        if psnr > best_psnr:
-                            best_psnr = psnr
-                            best_params_psnr = (wavelet, level, threshold_factor, threshold_mode)
-                            best_denoised_psnr = denoised_image
-
-                        if ssim > best_ssim:
-                            best_ssim = ssim
-                            best_params_ssim = (wavelet, level, threshold_factor, threshold_mode)
-                            best_denoised_ssim = denoised_image
-
-        denoised_image_nl_means = nl_means_denoising(noisy_image)
-        psnr_nl_means = compute_psnr(image_float, denoised_image_nl_means)
-        ssim_nl_means = compute_ssim(image_float, denoised_image_nl_means)
-
-        if psnr_nl_means > best_psnr:
-            best_psnr = psnr_nl_means
-            best_denoised_psnr = denoised_image_nl_means
-
-        if ssim_nl_means > best_ssim:
-            best_ssim = ssim_nl_means
-            best_denoised_ssim = denoised_image_nl_means
-
-        def image_to_base64(image):
-            buf = BytesIO()
-            plt.imsave(buf, image, format='png', cmap='gray')
-            buf.seek(0)
-            return base64.b64encode(buf.getvalue()).decode('utf-8')
-
-        context = {
-                'original_image': image_to_base64(image_float),
-                'noisy_image': image_to_base64(noisy_image),
-                'best_denoised_psnr': image_to_base64(best_denoised_psnr),
-                'best_denoised_ssim': image_to_base64(best_denoised_ssim),
-                'best_psnr': best_psnr,
-                'best_ssim': best_ssim,
-                'best_params_psnr': best_params_psnr,
-                'best_params_ssim': best_params_ssim,
-        }
-
-        return render(request, 'wavelet_webapp/enhancement_success.html', context)
-
-    return render(request, 'wavelet_webapp/enhance_image.html', {'uploaded_image': uploaded_image})
 
+    if request.method == 'POST':
+        form = DenoisingGridForm(request.POST)
+        if form.is_valid():
+            job = submit_job(uploaded_image, 'enhance', {'grid': form.grid()})
+            return redirect('job_detail', job_id=job.id)
+    else:
+        form = DenoisingGridForm()
+
+    return render(request, 'wavelet_webapp/enhance_image.html', {'uploaded_image': uploaded_image, 'form': form})
+
+
+def _artifact_path(name):
+    path = media_path(name)
+    root = os.path.realpath(media_path(ARTIFACTS_DIR))
+    if os.path.commonpath([root, os.path.realpath(path)]) != root or not os.path.isfile(path):
+        raise Http404('Artifact not found')
+    return path
+
+
+def _artifact_response(name, as_attachment):
+    path = _artifact_path(name)
+    return FileResponse(open(path, 'rb'), as_attachment=as_attachment, filename=os.path.basename(path))
+
+
+def download_artifact(request, name):
+    return _artifact_response(name, as_attachment=True)
+
+
+def artifact_file(request, name):
+    response = _artifact_response(name, as_attachment=False)
+    patch_cache_control(response, public=True, max_age=settings.WAVELET_ARTIFACT_RETENTION, immutable=True)
+    return response
+
+
+def compressed_preview(request, name):
+    if not name.endswith(('.wlt', '.wltt')):
+        raise Http404('Not a compressed artifact')
+    path = _artifact_path(name)
+    try:
+        scale = int(request.GET['scale']) if 'scale' in request.GET else None
+        max_bytes = int(request.GET['max_bytes']) if 'max_bytes' in request.GET else None
+        if (scale is not None and scale < 1) or (max_bytes is not None and max_bytes < 0):
+            raise ValueError
+    except ValueError:
+        return HttpResponseBadRequest('scale must be a positive integer and max_bytes a non-negative integer')
+
+    try:
+        with stage('preview.decode'):
+            if name.endswith('.wltt'):
+                if scale is None and max_bytes is None:
+                    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                        shape = read_tiled_header(mapped)[0]['shape']
+                    scale = preview_scale(shape, settings.WAVELET_THUMBNAIL_SIZE)
+                preview = preview_tiled(path, scale or 1, max_bytes)
+            else:
+                with open_bitstream(path) as mapped:
+                    if scale is None and max_bytes is None:
+                        scale = preview_scale(read_layout(mapped)[0]['shape'], settings.WAVELET_THUMBNAIL_SIZE)
+                    preview = decompress_image(mapped, scale=scale or 1, max_bytes=max_bytes)
+    except BitstreamError as e:
+        return HttpResponseBadRequest(str(e))
+
+    response = HttpResponse(content_type='image/png')
+    with stage('png.encode'):
+        preview.save(response, 'PNG', compress_level=1)
+    patch_cache_control(response, public=True, max_age=settings.WAVELET_ARTIFACT_RETENTION, immutable=True)
+    return response
+
+
+def job_detail(request, job_id):
+    fail_stale_jobs()
+    job = Job.objects.get(pk=job_id)
+
+    if job.status == Job.DONE:
+        response = render(request, SUCCESS_TEMPLATES[job.operation], job.result)
+        response.job_timings = job.timings
+        return response
+
+    return render(request, 'wavelet_webapp/job_status.html', {'job': job, 'failure_message': FAILURE_MESSAGE})
+
+
+def job_status(request, job_id):
+    fail_stale_jobs()
+    job = Job.objects.get(pk=job_id)
+    return JsonResponse({
+        'id': job.id,
+        'operation': job.operation,
+        'status': job.status,
+        'progress': job.progress,
+        'error': FAILURE_MESSAGE if job.status == Job.FAILED else '',
+        'result_url': reverse('job_detail', args=[job.id]) if job.status == Job.DONE else None,
+        'timings': job.timings,
+    })
+
+
+def metrics(request):
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Metrics are restricted to staff'}, status=403)
+    return JsonResponse({'stages': metrics_snapshot(), 'cache': cache_stats()})
+
+
+def _batch_paths(paths):
+    if paths and settings.WAVELET_BATCH_ROOT is None:
+        raise ValueError('Batch paths are disabled; pass uploaded image ids instead')
+    root = os.path.realpath(settings.WAVELET_BATCH_ROOT or '.')
+    resolved = []
+    for path in paths:
+        full_path = os.path.realpath(os.path.join(root, path))
+        if os.path.commonpath([root, full_path]) != root:
+            raise ValueError(f'Path {path!r} is outside the batch root')
+        resolved.append(full_path)
+    return resolved
+
+
+@require_POST
+def batch_process(request):
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Batch processing is restricted to staff'}, status=403)
+    try:
+        payload = json.loads(request.body)
+        operation = payload['operation']
+        if operation not in OPERATIONS:
+            raise ValueError(f'Unknown operation {operation!r}')
+        batch_id = payload.get('batch') or uuid.uuid4().hex
+        if not re.fullmatch(r'[\w-]+', batch_id):
+            raise ValueError('Batch names may only contain letters, digits, underscores and hyphens')
+        sources = collect_sources(_batch_paths(payload.get('paths', [])), [int(i) for i in payload.get('ids', [])])
+    except (KeyError, TypeError, ValueError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    output_path = media_path(f'batches/{batch_id}.jsonl')
+    records = run_batch(sources, operation, output_path, payload.get('params', {}),
+                        max_workers=settings.WAVELET_BATCH_WORKERS, chunk_size=settings.WAVELET_BATCH_CHUNK_SIZE,
+                        executor=get_batch_executor())
+    response = StreamingHttpResponse((json.dumps(record) + '\n' for record in records),
+                                     content_type='application/x-ndjson')
+    response['X-Batch-Id'] = batch_id
+    return response
@@ -0,0 +1,8 @@
+import os
+
+import django
+
+
+def init_worker(settings_module):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    django.setup()